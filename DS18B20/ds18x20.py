@@ -22,6 +22,11 @@ Call read_temps to read all sensors:
 >>> print(result)
 [20.875, 20.8125]
 
+With many sensors, pass bulk=True to start the conversion on all of them
+at once and wait only once (about 750ms), instead of once per sensor:
+
+>>> result = d.read_temps(bulk=True)
+
 Call read_temp to read the temperature of a specific sensor:
 
 >>> result = d.read_temp(d.roms[0])
@@ -60,16 +65,43 @@ class DS18X20:
         while True:
             if ow.read_bit():
                 break
+        return self.read_scratch(rom)
+
+    def convert_all(self):
+        """
+        Start a temperature conversion on all devices at once (Skip ROM) and
+        wait until the last one is done.  The bus reads 0 while any device is
+        still converting.  Read the results with read_scratch.
+        """
+        ow = self.ow
+        ow.reset()
+        ow.skip_rom()
+        ow.write_byte(0x44)  # Convert Temp
+        while True:
+            if ow.read_bit():
+                break
+
+    def read_scratch(self, rom):
+        """
+        Read and return the temperature of the last conversion of one device,
+        without starting a new one.
+        """
+        ow = self.ow
         ow.reset()
         ow.select_rom(rom)
         ow.write_byte(0xbe)  # Read scratch
         data = ow.read_bytes(9)
         return self.convert_temp(rom[0], data)
 
-    def read_temps(self):
+    def read_temps(self, bulk=False):
         """
         Read and return the temperatures of all attached DS18x20 devices.
+        With bulk=True all devices convert in parallel, so the time taken
+        doesn't grow with the number of devices beyond the scratchpad reads.
         """
+        if bulk:
+            self.convert_all()
+            return [self.read_scratch(rom) for rom in self.roms]
         temps = []
         for rom in self.roms:
             temps.append(self.read_temp(rom))
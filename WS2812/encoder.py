@@ -0,0 +1,128 @@
+from WS2812.pixelbuffer import PixelBuffer
+
+# Table driven WS2812 encoding, shared by WS2812RMT and WS2812SPI. Each
+# backend gives entry(c), the size bytes it sends for a colour byte of
+# value c (its 8 bits, MSB first): 8 RMT words for WS2812RMT, 3 SPI
+# bytes for WS2812SPI. A table holds the entry of every byte value, so
+# that a colour byte is encoded with a single block copy. Brightness
+# (0-255) and gamma are applied to the value first, so they cost nothing
+# per frame. Tables are shared between channels and strips with the same
+# settings and dropped once no strip uses them: (entry, size, level,
+# gamma) -> [table, number of users].
+_luts = {}
+
+def _BuildLUT(entry, size, level = 255, gamma = 1.0):
+    key = (entry, size, level, gamma)
+    e = _luts.get(key)
+    if e is not None:
+        e[1] += 1
+        return e[0]
+    lut = bytearray(256*size)
+    for v in range(256):
+        c = int(255 * (v / 255) ** gamma * level / 255 + 0.5)
+        lut[v*size:(v+1)*size] = entry(c)
+    _luts[key] = [lut, 1]
+    return lut
+
+# Drop a reference taken with _BuildLUT()
+def _FreeLUT(entry, size, level, gamma):
+    key = (entry, size, level, gamma)
+    e = _luts[key]
+    e[1] -= 1
+    if not e[1]:
+        del _luts[key]
+
+class Encoder:
+    # order is the colour order on the wire: 'GRB' for WS2812, 'RGB',
+    # or 'GRBW' for RGBW SK6812 strips, whose pixels are then (red,
+    # green, blue, white). brightness is 0-255, or a tuple with one
+    # level per colour of the pixels, e.g. for white balance.
+    def __init__(self, entry, size, order = 'GRB', brightness = 255, gamma = 1.0):
+        self.entry = entry
+        self.size = size
+        # PixelBuffer whose pixels are encoded in the backend's buffer
+        self.shown = None
+        self.lutKeys = None
+        self.Configure(order, brightness, gamma)
+
+    # Build the encoding tables: for each colour on the wire, the index
+    # of the colour in a pixel and its table. Encoded pixels are redone
+    # on the next Display().
+    def Configure(self, order = 'GRB', brightness = 255, gamma = 1.0):
+        self.bpp = len(order)
+        if type(brightness) is int:
+            brightness = (brightness,) * self.bpp
+        assert len(brightness) == self.bpp
+        self.src = ['RGBW'.index(c) for c in order]
+        keys = [(self.entry, self.size, brightness[i], gamma) for i in self.src]
+        self.luts = [memoryview(_BuildLUT(*k)) for k in keys]
+        if self.lutKeys:
+            for k in self.lutKeys:
+                _FreeLUT(*k)
+        self.lutKeys = keys
+        self.shown = None
+
+    # Encode data, a list of (red, green, blue[, white]) or a PixelBuffer,
+    # into buf with pixel 0 at byte offset o. Of a PixelBuffer only the
+    # pixels changed since it was last encoded are redone. Returns the
+    # offset after the last pixel.
+    def _Fill(self, data, buf, o):
+        if not isinstance(data, PixelBuffer):
+            self.shown = None
+            return self._EncodeList(data, buf, o)
+        if data is not self.shown:
+            data.Touch(0, data.n)
+            self.shown = data
+        if data.lo < data.hi:
+            self._EncodePixels(data, data.lo, data.hi, buf, o)
+            data.Clean()
+        return o + data.n*self.size*self.bpp
+
+    def _EncodeList(self, data, buf, o):
+        n = self.size
+        n2 = 2*n
+        n3 = 3*n
+        l0, l1, l2 = self.luts[:3]
+        s0, s1, s2 = self.src[:3]
+        l3 = self.luts[3] if self.bpp == 4 else None
+        s3 = self.src[3] if self.bpp == 4 else 0
+        for pixel in data:
+            v = pixel[s0]*n
+            buf[o   :o+n ] = l0[v:v+n]
+            v = pixel[s1]*n
+            buf[o+n :o+n2] = l1[v:v+n]
+            v = pixel[s2]*n
+            buf[o+n2:o+n3] = l2[v:v+n]
+            o += n3
+            if l3 is not None:
+                v = pixel[s3]*n
+                buf[o:o+n] = l3[v:v+n]
+                o += n
+        return o
+
+    # Encode pixels [lo, hi) of a PixelBuffer into buf, where pixel 0
+    # starts at byte offset o.
+    def _EncodePixels(self, px, lo, hi, buf, o):
+        n = self.size
+        n2 = 2*n
+        n3 = 3*n
+        bpp = self.bpp
+        assert px.bpp == bpp
+        l0, l1, l2 = self.luts[:3]
+        s0, s1, s2 = self.src[:3]
+        l3 = self.luts[3] if bpp == 4 else None
+        s3 = self.src[3] if bpp == 4 else 0
+        b = px.buf
+        o += lo*n*bpp
+        for i in range(bpp*lo, bpp*hi, bpp):
+            v = b[i+s0]*n
+            buf[o   :o+n ] = l0[v:v+n]
+            v = b[i+s1]*n
+            buf[o+n :o+n2] = l1[v:v+n]
+            v = b[i+s2]*n
+            buf[o+n2:o+n3] = l2[v:v+n]
+            o += n3
+            if l3 is not None:
+                v = b[i+s3]*n
+                buf[o:o+n] = l3[v:v+n]
+                o += n
@@ -0,0 +1,88 @@
+from esp32 import esp32
+import utime
+
+# Fixed frame rate pacing on one of the ESP32 64-bit hardware timers,
+# counting in microseconds. Frame deadlines are absolute (start + k *
+# period), so the rate doesn't drift with the time spent per frame. A
+# frame that overruns its slot is counted in .overruns, and deadlines it
+# made impossible to meet are skipped and counted in .skipped.
+#
+# Phase timings: Mark(i) adds the time since the previous Wait() or
+# Mark() to phase i, see Stats().
+#
+# s = FrameScheduler(25, ("render", "encode", "transmit"))
+# while True:
+#     s.Wait()
+#     px.Rotate(1)
+#     s.Mark(0)
+#     ws2812.Display(px)
+#     s.Mark(1)
+#     ws2812.WaitSent()
+#     s.Mark(2)
+
+class FrameScheduler:
+    def __init__(self, fps, phases=(), timer=0):
+        self.period = 1000000 // fps
+        self.phases = phases
+        self.timer = esp32.timer[timer]
+        regs = self.timer.regs
+        regs.enable = 0
+        regs.increase = 1
+        regs.autoreload = 0
+        regs.divider = 80   # 80MHz APB clock -> 1us per count
+        self.timer(0)
+        regs.enable = 1
+        self.Reset()
+
+    def Reset(self):
+        self._next = None
+        self._t = 0
+        self.frames = 0
+        self.overruns = 0
+        self.skipped = 0
+        n = len(self.phases)
+        self.total = [0] * n
+        self.max = [0] * n
+
+    # Wait for the next frame deadline.
+    def Wait(self):
+        now = self.timer()
+        if self._next is None:
+            self._next = now
+        late = now - self._next
+        if late > 0:
+            self.overruns += 1
+            if late >= self.period:
+                k = late // self.period
+                self.skipped += k
+                self._next += k * self.period
+        elif late < 0:
+            regs = self.timer.regs
+            self.timer.alarm(self._next)
+            regs.alarm_en = 1
+            ms = -late // 1000 - 1
+            if ms > 0:
+                utime.sleep_ms(ms)
+            # Spin on the alarm for the last millisecond. It only fires
+            # when the count equals the alarm, so also stop once the
+            # deadline has passed, e.g. after sleep_ms() overslept.
+            while regs.alarm_en:
+                if self.timer() >= self._next:
+                    regs.alarm_en = 0
+        # Phase times start from the deadline, or from now when late
+        self._t = now if late > 0 else self._next
+        self._next += self.period
+        self.frames += 1
+
+    def Mark(self, i):
+        now = self.timer()
+        d = now - self._t
+        self._t = now
+        self.total[i] += d
+        if d > self.max[i]:
+            self.max[i] = d
+
+    # (name, average us, max us) per phase.
+    def Stats(self):
+        n = self.frames or 1
+        return [(self.phases[i], self.total[i] // n, self.max[i]) for i in range(len(self.phases))]
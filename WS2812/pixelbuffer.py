@@ -0,0 +1,98 @@
+# Frame buffer for LED strips: n pixels of 3 bytes (red, green, blue),
+# or 4 with bpp=4 for RGBW strips (red, green, blue, white), in one flat
+# bytearray. Changed pixels are tracked as a single dirty
+# range so that drivers only re-encode what changed since the last
+# Display().
+#
+# px = PixelBuffer(60)
+# px[0] = (255, 102, 0)
+# while True:
+#     px.Rotate(1)
+#     ws2812.Display(px)
+
+class PixelBuffer:
+    def __init__(self, n, bpp = 3):
+        self.n = n
+        self.bpp = bpp
+        self.buf = bytearray(bpp*n)
+        self._tmp = None
+        # Dirty pixel range [lo, hi), empty when lo >= hi
+        self.lo = 0
+        self.hi = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        o = self.bpp*i
+        return tuple(self.buf[o:o+self.bpp])
+
+    def __setitem__(self, i, color):
+        if i < 0:
+            i += self.n
+        # A slice assignment of another length would resize buf
+        assert len(color) == self.bpp
+        o = self.bpp*i
+        self.buf[o:o+self.bpp] = bytes(color)
+        self.Touch(i, i+1)
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self[i]
+
+    def Set(self, i, red, green, blue, white = 0):
+        b = self.buf
+        o = self.bpp*i
+        b[o] = red
+        b[o+1] = green
+        b[o+2] = blue
+        if self.bpp == 4:
+            b[o+3] = white
+        self.Touch(i, i+1)
+
+    def Fill(self, red, green, blue, white = 0):
+        b = self.buf
+        b[0] = red
+        b[1] = green
+        b[2] = blue
+        if self.bpp == 4:
+            b[3] = white
+        # Double the filled part until the whole buffer is done
+        k = self.bpp
+        while k < len(b):
+            m = min(k, len(b) - k)
+            b[k:k+m] = b[:m]
+            k += m
+        self.Touch(0, self.n)
+
+    # Shift all pixels by k positions towards the start (towards the
+    # end if k < 0), wrapping around. The pixels are copied to a second
+    # buffer of the same size, allocated once, which then becomes
+    # self.buf: two block copies and no allocation per call.
+    def Rotate(self, k=1):
+        n = self.bpp*self.n
+        s = self.bpp*(k % self.n)
+        if not s:
+            return
+        if self._tmp is None:
+            self._tmp = bytearray(n)
+        src = memoryview(self.buf)
+        dst = memoryview(self._tmp)
+        dst[:n-s] = src[s:]
+        dst[n-s:] = src[:s]
+        self.buf, self._tmp = self._tmp, self.buf
+        self.Touch(0, self.n)
+
+    # Mark pixels [lo, hi) as changed, e.g. after writing self.buf
+    # directly.
+    def Touch(self, lo, hi):
+        if self.lo >= self.hi:
+            self.lo = lo
+            self.hi = hi
+        else:
+            self.lo = min(self.lo, lo)
+            self.hi = max(self.hi, hi)
+
+    # Called by the driver once the dirty pixels are encoded.
+    def Clean(self):
+        self.lo = self.hi = 0
@@ -0,0 +1,222 @@
+# Encoding throughput of WS2812RMT and WS2812SPI, run on the host:
+#
+#   python3 WS2812/rmt_bench.py -o results.json
+#   python3 WS2812/rmt_bench.py --compare results.json
+#
+# Uses rmt_sim to run the driver under CPython. Every case is first
+# checked once with the transmitter model (decoded pixels must match and
+# all pulses be within the WS2812 timings), then timed with decoding off
+# so that only the driver is measured. Reports encoded pixels/s; the
+# absolute numbers are CPython's, compare runs on the same machine.
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import rmt_sim
+sim = rmt_sim.install()
+from WS2812.ws2812rmt import WS2812RMT, WS2812Multi
+from WS2812.ws2812spi import WS2812SPI
+from WS2812.pixelbuffer import PixelBuffer
+
+
+def _colors(n, bpp=3):
+    return [tuple((i * 37 + k * 101) & 0xff for k in range(bpp)) for i in range(n)]
+
+
+# Send one frame with decoding on; expected() gives the pixels each
+# channel should have sent. No refill of the given strips may be late.
+def _check(name, send, expected, order="GRB", strips=()):
+    del sim.errors[:]
+    sim.decode = True
+    for s in strips:
+        s.underruns = 0
+    chans = send()
+    for s in strips:
+        if s.underruns:
+            raise AssertionError("%s: channel %d underrun" % (name, s.channel))
+    for ch, exp in zip(chans, expected()):
+        got = rmt_sim.pixels(sim.frames[ch][-1], order)
+        if got != exp:
+            raise AssertionError("%s: channel %d sent wrong pixels" % (name, ch))
+    if sim.errors:
+        raise AssertionError("%s: %s" % (name, sim.errors[0]))
+
+
+def _time(name, send, pixels, n):
+    sim.decode = False
+    send()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        send()
+    elapsed = time.perf_counter() - t0
+    return {
+        "name": name,
+        "frames": n,
+        "pixels": pixels,
+        "frames_per_s": round(n / elapsed, 1),
+        "pixels_per_s": round(n * pixels / elapsed),
+    }
+
+
+def bench_list(leds, n):
+    ws = WS2812RMT(0)
+    data = _colors(leds)
+
+    def send():
+        ws.Display(data)
+        ws.WaitSent()
+        return (0,)
+    name = "list_%d" % leds
+    _check(name, send, lambda: (data,), strips=(ws,))
+    return _time(name, send, leds, n)
+
+
+# PixelBuffer with all pixels changed (Rotate) or one pixel per frame.
+def bench_pixels(leds, n, dirty):
+    ws = WS2812RMT(0)
+    px = PixelBuffer(leds)
+    for i, c in enumerate(_colors(leds)):
+        px[i] = c
+
+    def send():
+        if dirty == leds:
+            px.Rotate(1)
+        else:
+            px.Set(0, px.buf[0] ^ 1, 0, 0)
+        ws.Display(px)
+        ws.WaitSent()
+        return (0,)
+    name = "pixels_%d_dirty_%d" % (leds, dirty)
+    # Twice: the first frame encodes everything
+    _check(name, send, lambda: (list(px),))
+    _check(name, send, lambda: (list(px),))
+    return _time(name, send, dirty, n)
+
+
+def bench_rgbw(leds, n):
+    ws = WS2812RMT(0, order="GRBW", brightness=200, gamma=2.2)
+    data = _colors(leds, 4)
+
+    def send():
+        ws.Display(data)
+        ws.WaitSent()
+        return (0,)
+    name = "rgbw_%d" % leds
+    scale = [int(255 * (v / 255) ** 2.2 * 200 / 255 + 0.5) for v in range(256)]
+    _check(name, send, lambda: ([tuple(scale[v] for v in c) for c in data],), "GRBW")
+    return _time(name, send, leds, n)
+
+
+def bench_multi(strips, leds, n):
+    m = WS2812Multi(("P21", "P20", "P19", "P22", "P23", "P11", "P12", "P10")[:strips])
+    data = [_colors(leds) for _ in range(strips)]
+
+    def send():
+        m.ShowAll(data)
+        m.WaitSent()
+        return [s.channel for s in m.strips]
+    name = "multi_%dx%d" % (strips, leds)
+    _check(name, send, lambda: data, strips=m.strips)
+    res = _time(name, send, strips * leds, n)
+    for s in m.strips:
+        if s.underruns:
+            raise AssertionError("%s: channel %d underrun" % (name, s.channel))
+    return res
+
+
+# SPI backend: checked with rmt_sim.spi_bytes() instead of the RMT model,
+# sent by DMA or, with dma False, with spi.write().
+def bench_spi(leds, n, dirty, dma=True):
+    ws = WS2812SPI(dma=dma)
+    if dma and ws.host is None:
+        raise AssertionError("spi: SPI block not found, no DMA")
+    px = PixelBuffer(leds)
+    for i, c in enumerate(_colors(leds)):
+        px[i] = c
+
+    def send():
+        if dirty == leds:
+            px.Rotate(1)
+        else:
+            px.Set(0, px.buf[0] ^ 1, 0, 0)
+        ws.Display(px)
+        ws.WaitSent()
+        del ws.spi.written[:-1]
+    name = "spi_%d_dirty_%d" % (leds, dirty) + ("" if dma else "_write")
+    del sim.errors[:]
+    sim.decode = True
+    errors = []
+    for _ in range(2):
+        send()
+        if rmt_sim.pixels(rmt_sim.spi_bytes(ws.spi.written[-1], errors)) != list(px):
+            raise AssertionError("%s: wrong pixels" % name)
+    errors += sim.errors
+    if errors:
+        raise AssertionError("%s: %s" % (name, errors[0]))
+    return _time(name, send, dirty, n)
+
+
+def run(n=200, quick=False):
+    if quick:
+        n = 20
+    results = [
+        bench_list(16, n * 4),
+        bench_list(300, n),
+        bench_pixels(16, n * 4, 16),
+        bench_pixels(300, n, 300),
+        bench_pixels(300, n * 4, 1),
+        bench_rgbw(16, n * 4),
+        bench_multi(4, 100, n),
+        bench_spi(300, n, 300),
+        bench_spi(1000, n // 2, 1000),
+        bench_spi(1000, n * 4, 1),
+        bench_spi(1000, n // 2, 1000, dma=False),
+    ]
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "time": int(time.time()),
+        },
+        "results": results,
+    }
+
+
+# Print the change of each case against a previous run, flagging
+# throughput drops over 10%.
+def compare(old, new):
+    prev = {r["name"]: r for r in old["results"]}
+    for r in new["results"]:
+        o = prev.get(r["name"])
+        if o is None:
+            continue
+        ratio = r["pixels_per_s"] / o["pixels_per_s"]
+        flag = "  <-- regression" if ratio < 0.9 else ""
+        print("%-24s %10d -> %10d pixels/s (%+.0f%%)%s" % (
+            r["name"], o["pixels_per_s"], r["pixels_per_s"], (ratio - 1) * 100, flag))
+
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(description="WS2812 encoding benchmark")
+    p.add_argument("-n", type=int, default=200, help="frames per case")
+    p.add_argument("-o", "--output", help="write results as JSON to this file")
+    p.add_argument("--compare", help="previous JSON results to compare with")
+    p.add_argument("--quick", action="store_true", help="short run")
+    args = p.parse_args()
+    res = run(args.n, args.quick)
+    for r in res["results"]:
+        print("%-24s %10d pixels/s %8.1f frames/s" % (r["name"], r["pixels_per_s"], r["frames_per_s"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(res, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), res)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,523 @@
+# Run the WS2812 driver under CPython: memory-backed stand-ins for
+# uctypes, machine, pycom and utime, and a model of the RMT transmitter
+# that decodes what the driver leaves in RMT RAM back into bytes, with
+# every pulse checked against the WS2812 timings.
+#
+# import rmt_sim
+# sim = rmt_sim.install()
+# from WS2812.ws2812rmt import WS2812RMT
+# ws = WS2812RMT(0)
+# ws.Display([(255, 0, 0)])
+# ws.WaitSent()
+# rmt_sim.pixels(sim.frames[0][-1])    # -> [(255, 0, 0)], sim.errors == []
+#
+# WS2812SPI output is checked the same way with spi_bytes(): its DMA
+# transfers, read through the descriptors like the hardware does, land
+# in the .written list of the machine.SPI stand-in, next to spi.write()s.
+#
+# The transmitter is not timed: in wrap mode it sends the next half of
+# the channel memory when the driver polls the interrupt status after
+# clearing tx_thr_event. If the event is left set for STALL polls, e.g.
+# once the driver has nothing more to refill and waits for tx_end, it
+# carries on regardless, as the hardware would.
+import os
+import struct
+import sys
+import time
+import types
+
+RMT_BASE = 0x3ff56000
+RMT_RAM = RMT_BASE + 0x800
+TIMG = (0x3ff5f000, 0x3ff5f024, 0x3ff60000, 0x3ff60024)
+SPI_HOSTS = (0x3ff64000, 0x3ff65000)
+DPORT = 0x3ff00000
+
+# WS2812 timings in ns: (min, max) of T0H, T0L, T1H, T1L and the reset
+T0H = (250, 550)
+T0L = (700, 1000)
+T1H = (650, 950)
+T1L = (300, 600)
+RES = 50000
+
+STALL = 64
+
+
+# Sparse 32-bit address space of 4 KB pages, with hooks on some words.
+class Memory:
+
+    def __init__(self):
+        self.pages = {}
+        self.on_read = {}
+        self.on_write = {}
+
+    def page(self, addr):
+        base = addr & ~0xfff
+        p = self.pages.get(base)
+        if p is None:
+            p = self.pages[base] = bytearray(0x1000)
+        return p, addr - base
+
+    def read32(self, addr):
+        h = self.on_read.get(addr)
+        if h is not None:
+            h()
+        p, o = self.page(addr)
+        if o <= 0xffc:
+            return struct.unpack_from("<I", p, o)[0]
+        return sum(self.page(addr + i)[0][(o + i) & 0xfff] << 8 * i for i in range(4))
+
+    def write32(self, addr, v):
+        p, o = self.page(addr)
+        if o <= 0xffc:
+            struct.pack_into("<I", p, o, v)
+        else:
+            for i in range(4):
+                q, j = self.page(addr + i)
+                q[j] = v >> 8 * i & 0xff
+        h = self.on_write.get(addr)
+        if h is not None:
+            h(v)
+
+
+mem = Memory()
+
+# uctypes descriptor encoding: offset in bits 0-16, bitfield position in
+# 17-21 and length in 22-26, type in 27-31.
+BF_POS = 17
+BF_LEN = 22
+UINT32 = 1 << 27
+BFUINT32 = 2 << 27
+ARRAY = 3 << 27
+UINT8 = 4 << 27
+NATIVE = LITTLE_ENDIAN = 0
+_OFF = (1 << 17) - 1
+
+
+def _size(desc):
+    if isinstance(desc, dict):
+        return max(_size(f) + ((f[0] if isinstance(f, tuple) else f) & _OFF)
+                   for f in desc.values())
+    if isinstance(desc, tuple):
+        if desc[0] & ~_OFF == ARRAY:
+            if isinstance(desc[1], int) and len(desc) == 2:
+                return (desc[1] & _OFF) * 4
+            return desc[1] * _size(desc[2])
+        return _size(desc[1])
+    return 1 if desc & ~_OFF == UINT8 else 4
+
+
+def _get(addr, f):
+    if isinstance(f, tuple):
+        return _wrap(addr + (f[0] & _OFF), f)
+    addr += f & _OFF
+    t = f & ~_OFF & (31 << 27)
+    if t == UINT8:
+        p, o = mem.page(addr)
+        return p[o]
+    v = mem.read32(addr)
+    if t == BFUINT32:
+        v = v >> (f >> BF_POS & 31) & (1 << (f >> BF_LEN & 31)) - 1
+    return v
+
+
+def _set(addr, f, v):
+    addr += f & _OFF
+    t = f & ~_OFF & (31 << 27)
+    if t == UINT8:
+        p, o = mem.page(addr)
+        p[o] = v & 0xff
+        return
+    if t == BFUINT32:
+        pos = f >> BF_POS & 31
+        m = ((1 << (f >> BF_LEN & 31)) - 1) << pos
+        v = mem.read32(addr) & ~m | v << pos & m
+    mem.write32(addr, v & 0xffffffff)
+
+
+def _wrap(addr, desc):
+    if isinstance(desc, tuple) and desc[0] & ~_OFF == ARRAY:
+        return Array(addr, desc)
+    if isinstance(desc, tuple):
+        desc = desc[1]
+    return Struct(addr, desc)
+
+
+class Struct:
+
+    def __init__(self, addr, desc):
+        self.__dict__["_addr"] = addr
+        self.__dict__["_desc"] = desc
+
+    def __getattr__(self, name):
+        return _get(self._addr, self._desc[name])
+
+    def __setattr__(self, name, v):
+        _set(self._addr, self._desc[name], v)
+
+
+class Array:
+
+    def __init__(self, addr, desc):
+        if len(desc) == 2:
+            # Array of scalars: (ARRAY | off, type | count)
+            self.n = desc[1] & _OFF
+            self.item = desc[1] & ~_OFF
+            self.size = 1 if self.item == UINT8 else 4
+        else:
+            self.n = desc[1]
+            self.item = desc[2]
+            self.size = _size(desc[2])
+        self.addr = addr
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        a = self.addr + i * self.size
+        if isinstance(self.item, dict):
+            return Struct(a, self.item)
+        return _get(a, self.item)
+
+    def __setitem__(self, i, v):
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        _set(self.addr + i * self.size, self.item, v)
+
+
+def struct_(addr, desc, layout=NATIVE):
+    return _wrap(addr, desc)
+
+
+def bytearray_at(addr, n):
+    p, o = mem.page(addr)
+    assert o + n <= 0x1000
+    return memoryview(p)[o:o + n]
+
+
+# uctypes.addressof(): buffers get word aligned addresses in internal
+# RAM, from ram_base on, and are kept alive so that DMA can read them.
+ram_base = 0x3ffb0000
+_ram = []
+
+
+def addressof(obj):
+    global ram_base
+    for a, o in _ram:
+        if o is obj:
+            return a
+    a = ram_base
+    ram_base += len(obj) + 15 & ~15
+    _ram.append((a, obj))
+    return a
+
+
+# n bytes at addr, from the buffer given that address.
+def ram_read(addr, n):
+    for a, o in _ram:
+        if a <= addr and addr + n <= a + len(o):
+            return bytes(memoryview(o)[addr - a:addr - a + n])
+    raise ValueError("no buffer at 0x%x" % addr)
+
+
+# Model of the 8 RMT transmitters.
+class RMT:
+
+    def __init__(self):
+        # Bytes sent per channel, one entry per frame
+        self.frames = [[] for _ in range(8)]
+        self.errors = []
+        # Channel -> [read position, words sent, pulses, stalled polls]
+        # while sending
+        self.active = {}
+        self.raw = 0
+        # With decode False nothing is decoded or checked: frames are
+        # sent instantly, to measure the driver alone.
+        self.decode = True
+        self._fast = 0
+        # Per channel, tx_thr_events cleared in the current frame when
+        # not decoding, for the read address
+        self._halves = [0] * 8
+        for ch in range(8):
+            mem.on_write[RMT_BASE + 0x24 + 8 * ch] = lambda v, ch=ch: self._conf1(ch, v)
+            mem.on_read[RMT_BASE + 0x60 + 4 * ch] = lambda ch=ch: self._status(ch)
+        mem.on_read[RMT_BASE + 0xa0] = self._poll
+        mem.on_write[RMT_BASE + 0xac] = self._clear
+        for t in TIMG:
+            mem.on_write[t + 0x0c] = lambda v, t=t: self._timer(t)
+
+    def _reg(self, off):
+        p, o = mem.page(RMT_BASE + off)
+        return struct.unpack_from("<I", p, o)[0]
+
+    def _set_raw(self, bits):
+        self.raw |= bits
+        p, o = mem.page(RMT_BASE + 0xa0)
+        struct.pack_into("<I", p, o, self.raw)
+
+    def _clear(self, v):
+        for ch in range(8):
+            if v & self._fast & 1 << 24 + ch:
+                self._halves[ch] += 1
+        self.raw &= ~v
+        p, o = mem.page(RMT_BASE + 0xa0)
+        struct.pack_into("<I", p, o, self.raw)
+        struct.pack_into("<I", p, o + 0xc, 0)
+
+    def _conf1(self, ch, v):
+        if not v & 1:
+            return
+        # tx_start is self-clearing
+        p, o = mem.page(RMT_BASE + 0x24 + 8 * ch)
+        struct.pack_into("<I", p, o, v & ~1)
+        self._halves[ch] = 0
+        if not self.decode:
+            self._fast |= 1 << 24 + ch
+            self._set_raw(1 << 3 * ch)
+            return
+        self._fast &= ~(1 << 24 + ch)
+        self.active[ch] = [0, 0, [], 0]
+        if not self._reg(0xf0) & 2:
+            # No wrap: all of it now
+            self._send(ch, None)
+
+    def _poll(self):
+        if self._fast:
+            self._set_raw(self._fast)
+        for ch in list(self.active):
+            st = self.active[ch]
+            if self.raw & 1 << 24 + ch and st[3] < STALL:
+                st[3] += 1
+                continue
+            st[3] = 0
+            self._send(ch, self._reg(0xd0 + 4 * ch) & 0x1ff)
+
+    # Status register: mem_raddr_ex, where the transmitter reads. When
+    # not decoding, the start of the half after the last one refilled.
+    def _status(self, ch):
+        size = (self._reg(0x20 + 8 * ch) >> 24 & 15) * 64
+        st = self.active.get(ch)
+        if st is not None:
+            pos = st[0] % size
+        else:
+            pos = self._halves[ch] % 2 * size // 2
+        p, o = mem.page(RMT_BASE + 0x60 + 4 * ch)
+        struct.pack_into("<I", p, o, (64 * ch + pos) << 12)
+
+    # Send up to lim words (all if None) of channel ch.
+    def _send(self, ch, lim):
+        st = self.active[ch]
+        size = (self._reg(0x20 + 8 * ch) >> 24 & 15) * 64
+        wrap = self._reg(0xf0) & 2
+        n = 0
+        while lim is None or n < lim:
+            if st[0] == size:
+                if not wrap:
+                    self.errors.append("ch%d: no end marker in channel memory" % ch)
+                    self._end(ch, st)
+                    return
+                st[0] = 0
+            w = mem.read32(RMT_RAM + 4 * (64 * ch + st[0]))
+            st[0] += 1
+            st[1] += 1
+            n += 1
+            for half in (w & 0xffff, w >> 16):
+                if not half & 0x7fff:
+                    self._end(ch, st)
+                    return
+                st[2].append((half >> 15, half & 0x7fff))
+            if lim and st[1] % lim == 0:
+                self._set_raw(1 << 24 + ch)
+                return
+
+    def _end(self, ch, st):
+        del self.active[ch]
+        div = self._reg(0x20 + 8 * ch) & 0xff or 256
+        self.frames[ch].append(self._verify(ch, st[2], 12.5 * div))
+        self._set_raw(1 << 3 * ch)
+
+    # Check pulses against the WS2812 timings and turn them into bytes.
+    def _verify(self, ch, pulses, tick_ns):
+        bits = []
+        i = 0
+        while i + 1 < len(pulses):
+            (l0, d0), (l1, d1) = pulses[i], pulses[i + 1]
+            h = d0 * tick_ns
+            lo = d1 * tick_ns
+            if l0 != 1 or l1 != 0:
+                if l0 == 0 and i + 2 >= len(pulses):
+                    break
+                self.errors.append("ch%d bit %d: levels %d,%d" % (ch, len(bits), l0, l1))
+                break
+            if T0H[0] <= h <= T0H[1] and T0L[0] <= lo <= T0L[1]:
+                bits.append(0)
+            elif T1H[0] <= h <= T1H[1] and T1L[0] <= lo <= T1L[1]:
+                bits.append(1)
+            else:
+                self.errors.append("ch%d bit %d: %dns high, %dns low" % (ch, len(bits), h, lo))
+                bits.append(h > 600)
+            i += 2
+        rest = pulses[i:]
+        if not rest or rest[-1][0] or rest[-1][1] * tick_ns < RES:
+            self.errors.append("ch%d: no reset pulse at the end" % ch)
+        if len(bits) % 8:
+            self.errors.append("ch%d: %d bits, not whole bytes" % (ch, len(bits)))
+        return bytes(sum(b << 7 - k for k, b in enumerate(bits[j:j + 8]))
+                     for j in range(0, len(bits) - 7, 8))
+
+    # TIMG update: latch the count, a 1 MHz clock with divider 80.
+    def _timer(self, t):
+        p, o = mem.page(t)
+        conf = struct.unpack_from("<I", p, o)[0]
+        div = conf >> 13 & 0xffff or 0x10000
+        v = int(time.perf_counter() * 80e6 / div)
+        struct.pack_into("<II", p, o + 4, v & 0xffffffff, v >> 32)
+
+
+# Bytes sent -> pixel tuples, for the colour order on the wire.
+def pixels(data, order="GRB"):
+    idx = [order.index(c) for c in "RGBW" if c in order]
+    n = len(order)
+    return [tuple(data[i + j] for j in idx) for i in range(0, len(data) - n + 1, n)]
+
+
+class _Pin:
+    OUT = 1
+    IN = 0
+
+    def __init__(self, *a, **kw):
+        pass
+
+
+# machine.SPI: keeps what was written, for spi_bytes(). Bus n is the
+# SPI block SPI_HOSTS[n], whose mosi_dlen a write sets.
+class _SPI:
+    MASTER = 0
+    MSB = 0
+    # SPI block -> its machine.SPI, for SPIDMA
+    hosts = {}
+
+    def __init__(self, bus, mode=0, baudrate=1000000, **kw):
+        self.baudrate = baudrate
+        self.written = []
+        self.host = SPI_HOSTS[bus]
+        _SPI.hosts[self.host] = self
+
+    def write(self, buf):
+        self.written.append(bytes(buf))
+        _set(self.host, BFUINT32 | 0x28 | 24 << BF_LEN, len(buf) * 8 - 1)
+
+
+# DMA transfers of the SPI blocks: setting usr sends mosi_dlen + 1 bits
+# from the descriptor chain at dma_out_link, at once. Errors go to the
+# RMT model's errors.
+class SPIDMA:
+
+    def __init__(self, rmt):
+        self.rmt = rmt
+        for i, h in enumerate(SPI_HOSTS):
+            mem.on_write[h] = lambda v, i=i: self._cmd(i, v)
+
+    def _cmd(self, i, v):
+        if not v & 1 << 18:
+            return
+        h = SPI_HOSTS[i]
+        # usr is cleared at the end of the transfer
+        mem.write32(h, v & ~(1 << 18))
+        if not self.rmt.decode:
+            return
+        errors = self.rmt.errors
+        if not mem.read32(DPORT + 0xc0) & 1 << 22:
+            errors.append("spi: DMA clock off")
+        if mem.read32(DPORT + 0x5a8) >> 2 * (i + 1) & 3 != i + 1:
+            errors.append("spi: DMA channel %d not selected" % (i + 1))
+        user = mem.read32(h + 0x1c)
+        if user >> 27 & 31 != 1:
+            errors.append("spi: user phases 0x%x, not MOSI only" % (user >> 27))
+        link = mem.read32(h + 0x104)
+        if not link & 1 << 29:
+            errors.append("spi: outlink not started")
+        nbits = (mem.read32(h + 0x28) & 0xffffff) + 1
+        data = b""
+        d = 0x3ff00000 | link & 0xfffff
+        while d:
+            w, buf, nxt = struct.unpack("<III", ram_read(d, 12))
+            size, length = w & 0xfff, w >> 12 & 0xfff
+            if not w & 1 << 31 or length > size or buf & 3:
+                errors.append("spi: bad descriptor at 0x%x" % d)
+                break
+            data += ram_read(buf, length)
+            if w & 1 << 30:
+                break
+            d = nxt
+        else:
+            errors.append("spi: descriptor chain without eof")
+        if len(data) * 8 != nbits:
+            errors.append("spi: %d bits in the descriptors, mosi_dlen %d" % (len(data) * 8, nbits))
+        _SPI.hosts[h].written.append(data)
+
+
+# Decode a WS2812SPI frame: each WS2812 bit is 3 SPI bits at 2.4MHz, 100
+# for a 0 and 110 for a 1, followed by > 50us of zeros. Problems are
+# added to errors.
+def spi_bytes(data, errors, baudrate=2400000):
+    bits = []
+    for b in data:
+        for i in range(7, -1, -1):
+            bits.append(b >> i & 1)
+    bit_ns = 1e9 / baudrate
+    end = len(bits)
+    while end and not bits[end - 1]:
+        end -= 1
+    # The last 1 ends a 110 or 10(0) triplet
+    n = (end + 2) // 3
+    if (len(bits) - 3 * n) * bit_ns < RES:
+        errors.append("spi: no reset pulse at the end")
+    out = []
+    for k in range(n):
+        t = tuple(bits[3 * k:3 * k + 3])
+        if t == (1, 0, 0):
+            out.append(0)
+        elif t == (1, 1, 0):
+            out.append(1)
+        else:
+            errors.append("spi bit %d: pattern %s" % (k, t))
+            out.append(0)
+    for h, lo, name in ((bit_ns, 2 * bit_ns, "0"), (2 * bit_ns, bit_ns, "1")):
+        spec = (T0H, T0L) if name == "0" else (T1H, T1L)
+        if not (spec[0][0] <= h <= spec[0][1] and spec[1][0] <= lo <= spec[1][1]):
+            errors.append("spi: %s bits are %dns high, %dns low" % (name, h, lo))
+    if len(out) % 8:
+        errors.append("spi: %d bits, not whole bytes" % len(out))
+    return bytes(sum(b << 7 - i for i, b in enumerate(out[j:j + 8]))
+                 for j in range(0, len(out) - 7, 8))
+
+
+def _module(name, **attrs):
+    m = types.ModuleType(name)
+    m.__dict__.update(attrs)
+    sys.modules[name] = m
+    return m
+
+
+def install():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    _module("uctypes", struct=struct_, bytearray_at=bytearray_at, addressof=addressof, UINT32=UINT32,
+            BFUINT32=BFUINT32, UINT8=UINT8, ARRAY=ARRAY, BF_POS=BF_POS, BF_LEN=BF_LEN,
+            NATIVE=NATIVE, LITTLE_ENDIAN=LITTLE_ENDIAN)
+    _module("machine", Pin=_Pin, SPI=_SPI)
+    _module("pycom", heartbeat=lambda on=None: None, rgbled=lambda c=None: None)
+    _module("utime",
+            ticks_ms=lambda: int(time.monotonic() * 1000),
+            ticks_us=lambda: int(time.monotonic() * 1000000),
+            ticks_diff=lambda a, b: a - b,
+            ticks_add=lambda a, b: a + b,
+            sleep_ms=lambda ms: time.sleep(ms / 1000),
+            sleep_us=lambda us: time.sleep(us / 1000000))
+    sys.modules["ustruct"] = struct
+    rmt = RMT()
+    rmt.spi = SPIDMA(rmt)
+    return rmt
@@ -2,7 +2,11 @@ from esp32 import esp32
 import machine
 import uctypes
 import utime
+import ustruct
 import pycom
+from WS2812.pixelbuffer import PixelBuffer
+from WS2812.encoder import Encoder
+from WS2812.framescheduler import FrameScheduler
 
 RMT_BASE = 0x3ff56000
 
@@ -37,6 +41,22 @@ apb_conf = uctypes.struct(RMT_BASE + 0xf0, {
         'mem_tx_wrap_en': uctypes.BFUINT32 | 0 | 1<<uctypes.BF_POS | 1<<uctypes.BF_LEN,
     })
 
+# Interrupt status, one tx_end bit at 3*ch, one tx_thr_event bit at 24+ch
+rmtInt = uctypes.struct(RMT_BASE + 0xa0, {
+        'raw': uctypes.UINT32 | 0x0,
+        'st': uctypes.UINT32 | 0x4,
+        'ena': uctypes.UINT32 | 0x8,
+        'clr': uctypes.UINT32 | 0xc,
+    })
+
+# tx_thr_event is raised every time tx_lim more words have been sent
+rmtTxLim = uctypes.struct(RMT_BASE + 0xd0, (uctypes.ARRAY | 0, uctypes.UINT32 | 8))
+
+# Channel status: mem_raddr_ex is the RMT RAM word the transmitter reads
+rmtStatus = uctypes.struct(RMT_BASE + 0x60, (uctypes.ARRAY | 0, 8, {
+        "mem_raddr_ex": uctypes.BFUINT32 | 0 | 12<<uctypes.BF_POS | 10<<uctypes.BF_LEN,
+    }))
+
 # RMT RAM is divided into 8 blocks of 64 words, each holding 2 entries. 
 # 1 LED = 3 bytes (Red, Green, Blue)
 # 1 transfert = 3 bytes / led + 1 byte (end of transfert)
@@ -52,29 +72,63 @@ WS2812_0 = 1<<15 | 4*8<<0  | 0<<31 | 4*17<<16
 WS2812_1 = 1<<15 | 4*16<<0 | 0<<31 | 4*9<<16
 WS_END   = 0<<15 | 4*20*50<<0 | 0<<31 | 0<<16  # ends transfer
 
+# Byte value -> its 8 RMT words (MSB first), the 32 byte table entry
+# of the Encoder
+def _Entry(c):
+    return ustruct.pack("<8I", *[WS2812_1 if c&(0x80>>i) else WS2812_0 for i in range(8)])
+
+# LoPy pin -> ESP32 GPIO, for the pins usable as outputs
+GPIO = {
+    'P2': 0, 'P3': 4, 'P4': 15, 'P5': 5, 'P6': 27, 'P7': 19, 'P8': 2,
+    'P9': 12, 'P10': 13, 'P11': 22, 'P12': 21, 'P19': 32, 'P20': 33,
+    'P21': 26, 'P22': 25, 'P23': 14,
+}
+
 DPORT = uctypes.struct(0x3ff00000, {
         'perip_clk_en': (0x0c0, {'rmt': uctypes.BFUINT32 | 0 | 9<<uctypes.BF_POS | 1<<uctypes.BF_LEN}),
         'perip_rst_en': (0x0c4, {'rmt': uctypes.BFUINT32 | 0 | 9<<uctypes.BF_POS | 1<<uctypes.BF_LEN}),
     })
 
-class WS2812RMT:
-    def __init__(self, channel = 0):
+class WS2812RMT(Encoder):
+    # A channel's memory starts at its own 64 word block and extends
+    # over the next blocks - 1 ones, whose channels can't be used then.
+    # The default takes all blocks up to the last one.
+    #
+    # order, brightness and gamma are those of Encoder.
+    def __init__(self, channel = 0, pin = 'P22', blocks = None, order = 'GRB', brightness = 255, gamma = 1.0):
         self.channel = channel
-        self.ram = uctypes.struct(RMT_BASE+0x800, (uctypes.ARRAY | 0x0, uctypes.UINT32 | 64*8))
+        self.pin = pin
+        self.blocks = blocks or 8 - channel
+        assert channel + self.blocks <= 8
+        self.words = 64 * self.blocks
+        # Whole frame encoded in RAM, for strips that don't fit the
+        # channel memory
+        self.frame = None
+        addr = RMT_BASE + 0x800 + channel*64*4
+        self.ram = uctypes.struct(addr, (uctypes.ARRAY | 0x0, uctypes.UINT32 | self.words))
+        # Same memory, byte addressed, for the block copies of Display()
+        self.ramBytes = memoryview(uctypes.bytearray_at(addr, self.words*4))
+        self._pos = 0
+        self._end = 0
+        self._half = 0
+        # Halves of the channel memory refilled too late, see _Refill()
+        self.underruns = 0
+        Encoder.__init__(self, _Entry, 32, order, brightness, gamma)
         self._LowLevelInitPin()
         self._LowLevelInitRMT()
         
     def _LowLevelInitPin(self):        
-        machine.Pin('P22', machine.Pin.OUT)
+        machine.Pin(self.pin, machine.Pin.OUT)
         
         # Inputs are 83+ch, outputs are 87+ch
-        # P22 = GPIO25 on ESP32
-        esp32.GPIO.func_out_sel_cfg[25].func = 87 + self.channel
+        esp32.GPIO.func_out_sel_cfg[GPIO[self.pin]].func = 87 + self.channel
             
     def _LowLevelInitRMT(self):       
-        DPORT.perip_rst_en.rmt = 1
-        DPORT.perip_clk_en.rmt = 1
-        DPORT.perip_rst_en.rmt = 0
+        if not DPORT.perip_clk_en.rmt:
+            # First channel in use, don't reset the others later on
+            DPORT.perip_rst_en.rmt = 1
+            DPORT.perip_clk_en.rmt = 1
+            DPORT.perip_rst_en.rmt = 0
         
         rmtConfiguration[self.channel].rx_en = 0
         rmtConfiguration[self.channel].mem_rd_rst = 1
@@ -83,40 +137,144 @@ class WS2812RMT:
         rmtConfiguration[self.channel].ref_always_on = 1 # use 80MHz clock
         rmtConfiguration[self.channel].idle_out_lv = 0
         rmtConfiguration[self.channel].div_cnt = 1 # divider. could go as high as 4
-        rmtConfiguration[self.channel].mem_size = 8 # Use all (8) memory block available
+        rmtConfiguration[self.channel].mem_size = self.blocks # Use all memory blocks available
         rmtConfiguration[self.channel].carrier_en = 0
         rmtConfiguration[self.channel].mem_pd = 0
         
+    # data is a list of (red, green, blue[, white]) or a PixelBuffer, of which
+    # only the pixels changed since the previous Display() are encoded.
     def Display(self,  data):
-        base = self.channel * 64
+        self._Load(data)
+        self._Start()
+        while self._Refill():
+            pass
+
+    # Encode data into the channel memory, or into frame when it
+    # doesn't fit.
+    def _Load(self, data):
         apb_conf.fifo_mask = 1	# If 0, RAM access is in FIFO mode
-        for red,  green,  blue in data:
-            for i in range(8):
-                rmtRam[base   +i] = WS2812_1 if green&(0x80>>i) else WS2812_0
-                rmtRam[base+ 8+i] = WS2812_1 if red&(0x80>>i) else WS2812_0
-                rmtRam[base+16+i] = WS2812_1 if blue&(0x80>>i) else WS2812_0            
-            base = base + 3*8
-        rmtRam[base] = WS_END
+        if len(data)*8*self.bpp + 1 <= self.words:
+            self._Fill(data, self.ramBytes, 0)
+            self._pos = self._end = 0
+            return
+        # Longer strips: the channel memory is used as a ring. In wrap
+        # mode the transmitter goes back to the start of its memory at
+        # the end, and tx_thr_event fires each time half of it has been
+        # sent, which _Refill() then loads with the next part of the
+        # frame while the other half is shifted out.
+        n = (len(data)*8*self.bpp + 1) * 4
+        if self.frame is None or len(self.frame) != n:
+            self.frame = None
+            self.frame = bytearray(n)
+            self.shown = None
+        frame = memoryview(self.frame)
+        self._Fill(data, frame, 0)
+        rmtTxLim[self.channel] = self.words // 2
+        apb_conf.mem_tx_wrap_en = 1
+        self.ramBytes[:] = frame[:self.words*4]
+        self._pos = self.words*4
+        self._end = n
+        self._half = 0
+
+    def _Start(self):
+        rmtInt.clr = 1 << (24 + self.channel) | 1 << (3*self.channel)
         rmtConfiguration[self.channel].mem_rd_rst = 1
         rmtConfiguration[self.channel].mem_owner = 0
         rmtConfiguration[self.channel].tx_start = 1
-        
+
+    # Refill the half of the channel memory just sent, if any. Returns
+    # False once the whole frame is in the channel memory.
+    def _Refill(self):
+        if self._pos >= self._end:
+            return False
+        thr = 1 << (24 + self.channel)
+        if not rmtInt.raw & thr:
+            return True
+        rmtInt.clr = thr
+        # A half is sent in blocks*40us at 800kHz, the copy has to be
+        # done before then
+        half = self.words * 2
+        k = min(half, self._end - self._pos)
+        o = self._half * half
+        self.ramBytes[o:o + k] = memoryview(self.frame)[self._pos:self._pos + k]
+        # The transmitter reads the other half unless it came back to
+        # this one before the copy was done: stale words went out, the
+        # frame is corrupted.
+        r = rmtStatus[self.channel].mem_raddr_ex - 64*self.channel
+        if r // (self.words // 2) % 2 == self._half:
+            self.underruns += 1
+        self._pos += k
+        self._half ^= 1
+        return self._pos < self._end
+
+    # Encode data at byte offset o of buf, then the WS_END word.
+    def _Fill(self, data, buf, o):
+        o = Encoder._Fill(self, data, buf, o)
+        ustruct.pack_into("<I", buf, o, WS_END)
+
+    # Wait until the frame started by Display() is sent (tx_end).
+    def WaitSent(self):
+        while not rmtInt.raw & 1 << (3*self.channel):
+            pass
+
+# Several strips driven in parallel, one RMT channel per pin, with the
+# 8 memory blocks split evenly between them. ShowAll() encodes every
+# strip, then starts all channels back to back so the strips are sent
+# at the same time.
+#
+# A strip fits its channel memory with up to (64*blocks - 1) // (8*bpp)
+# pixels, blocks being 8 // number of pins: 5 RGB pixels with 4 strips.
+# Longer strips are refilled from a single loop, each strip within
+# blocks*40us of its tx_thr_event (80us with 4 strips), which Python on
+# the ESP32 can't keep up with for more than a strip or two. A late
+# refill sends a corrupted frame and is counted in the strip's
+# .underruns: check it, or use fewer, shorter strips.
+#
+# strips = WS2812Multi(('P22', 'P21', 'P20', 'P19'))
+# strips.ShowAll((px0, px1, px2, px3))
+class WS2812Multi:
+    def __init__(self, pins):
+        assert 0 < len(pins) <= 8
+        blocks = 8 // len(pins)
+        self.strips = [WS2812RMT(channel = i*blocks, pin = pins[i], blocks = blocks)
+                       for i in range(len(pins))]
+
+    def ShowAll(self, datas):
+        strips = self.strips
+        for i in range(len(strips)):
+            strips[i]._Load(datas[i])
+        for s in strips:
+            s._Start()
+        busy = True
+        while busy:
+            busy = False
+            for s in strips:
+                if s._Refill():
+                    busy = True
+
+    def WaitSent(self):
+        for s in self.strips:
+            s.WaitSent()
+
 if __name__ == "__main__":
     pycom.heartbeat(False)
     
     ws2812 = WS2812RMT(channel = 0)
-    data = [(255, 102, 0), (127, 21, 0), (63, 10, 0), (31, 5, 0),
-        (15, 2, 0), (7, 1, 0), (0, 0, 0), (0,0,0),
-        (0, 0, 0), (0, 0, 0), (0, 0, 0), (0,0,0),
-        (0, 0, 0), (0, 0, 0), (0, 0, 0), (0,0,0)
-    ]
+    data = PixelBuffer(16)
+    for i, color in enumerate([(255, 102, 0), (127, 21, 0), (63, 10, 0), (31, 5, 0),
+        (15, 2, 0), (7, 1, 0)]):
+        data[i] = color
     
+    frames = FrameScheduler(25, ("render", "encode", "transmit"))
     while True:
-        t1 = utime.ticks_ms()
-        data = data[1:] + data[0:1]
+        frames.Wait()
+        data.Rotate(1)
+        frames.Mark(0)
         ws2812.Display(data)
-        t2 = utime.ticks_ms()
-        
-        utime.sleep_ms(40 - (t2-t1))
+        frames.Mark(1)
+        ws2812.WaitSent()
+        frames.Mark(2)
+        if frames.frames % 250 == 0:
+            print(frames.Stats(), frames.overruns, frames.skipped)
     
     
@@ -0,0 +1,175 @@
+import machine
+import uctypes
+import ustruct
+from WS2812.encoder import Encoder
+
+# WS2812 driver on an SPI bus, for strips too long for the RMT memory.
+# Only the MOSI pin is connected to the strip. At 2.4MHz each WS2812 bit
+# takes 3 SPI bits, 100 for a 0 and 110 for a 1 (417ns/833ns pulses), so
+# a colour byte is 3 SPI bytes. The whole frame is encoded into one
+# buffer, 9 bytes per LED.
+#
+# machine.SPI sets the bus up (pins, clock, mode), the frame is then sent
+# by DMA straight from the buffer: Display() starts the transfer and
+# returns, leaving the CPU free while the frame goes out, WaitSent()
+# waits for its end. The WS2812 bit rate makes a frame take 30us per LED
+# whatever the backend, e.g. 1000 LEDs at 33 frames/s per strip; for
+# more, drive strips on both buses, each Display() starting its DMA
+# before the first one is done. Where the DMA can't be used (the SPI
+# block machine.SPI drives isn't found, or the buffer is in external
+# RAM) or with dma = False, Display() sends with spi.write() and returns
+# once the frame is out.
+#
+# ws = WS2812SPI(pins = ('P10', 'P11', 'P14'))   # CLK, MOSI (data), MISO
+# px = PixelBuffer(1000)
+# ws.Display(px)
+# ... render the next frame into px ...
+# ws.WaitSent()
+#
+# Same colour order, brightness and gamma options as WS2812RMT, and the
+# same PixelBuffer dirty range handling.
+
+BAUDRATE = 2400000
+# Zero bytes after the frame: >50us low resets the strip. The frame is
+# padded to whole words for the DMA.
+RESET_BYTES = 20
+
+# SPI2 (HSPI) and SPI3 (VSPI), the blocks behind machine.SPI, each with
+# its own DMA channel (1 and 2).
+SPI_HOSTS = (0x3ff64000, 0x3ff65000)
+
+SPI_REGS = {
+        'usr': uctypes.BFUINT32 | 0x00 | 18<<uctypes.BF_POS | 1<<uctypes.BF_LEN,
+        # Transaction phases: usr_mosi, usr_miso, usr_dummy, usr_addr
+        # and usr_command, from bit 0
+        'phases': uctypes.BFUINT32 | 0x1c | 27<<uctypes.BF_POS | 5<<uctypes.BF_LEN,
+        'mosi_dlen': uctypes.BFUINT32 | 0x28 | 0<<uctypes.BF_POS | 24<<uctypes.BF_LEN,
+        'dma_conf': uctypes.UINT32 | 0x100,
+        'dma_out_link': uctypes.UINT32 | 0x104,
+    }
+
+spiHosts = [uctypes.struct(a, SPI_REGS) for a in SPI_HOSTS]
+
+# Data out only
+USR_MOSI = 1
+# dma_conf: in_rst, out_rst, ahbm_fifo_rst and ahbm_rst
+DMA_RESET = 0xf<<2
+# dma_out_link: start fetching descriptors from the address in bits 0-19
+OUTLINK_START = 1<<29
+
+DPORT = uctypes.struct(0x3ff00000, {
+        'perip_clk_en': (0x0c0, {'spi_dma': uctypes.BFUINT32 | 0 | 22<<uctypes.BF_POS | 1<<uctypes.BF_LEN}),
+        'perip_rst_en': (0x0c4, {'spi_dma': uctypes.BFUINT32 | 0 | 22<<uctypes.BF_POS | 1<<uctypes.BF_LEN}),
+        # 2 bits per SPI block: the DMA channel it uses
+        'spi_dma_chan_sel': uctypes.UINT32 | 0x5a8,
+    })
+
+# The DMA reads internal RAM only
+DMA_RAM = (0x3ffae000, 0x40000000)
+# DMA descriptor: size and length of the data in bits 0-11 and 12-23,
+# eof in bit 30 and owner (the DMA) in bit 31, then the data address and
+# the next descriptor's. A descriptor covers up to DESC_MAX bytes.
+DESC_MAX = 4092
+
+# Byte value -> its 3 SPI bytes, the table entry of the Encoder
+def _Entry(c):
+    bits = 0
+    for i in range(8):
+        bits = bits << 3 | (6 if c&(0x80>>i) else 4)
+    return bytes((bits >> 16, bits >> 8 & 0xff, bits & 0xff))
+
+class WS2812SPI(Encoder):
+    def __init__(self, bus = 0, pins = None, order = 'GRB', brightness = 255, gamma = 1.0, dma = True):
+        Encoder.__init__(self, _Entry, 3, order, brightness, gamma)
+        self.buf = None
+        # DMA descriptors for buf
+        self.desc = None
+        self._linked = None
+        self._outLink = 0
+        if pins is None:
+            self.spi = machine.SPI(bus, mode=machine.SPI.MASTER, baudrate=BAUDRATE, polarity=0, phase=0)
+        else:
+            self.spi = machine.SPI(bus, mode=machine.SPI.MASTER, baudrate=BAUDRATE, polarity=0, phase=0, pins=pins)
+        self.host = self._FindHost() if dma else None
+        if self.host is not None:
+            self._LowLevelInitDMA()
+
+    # The SPI block machine.SPI drives: the one a 23 byte write leaves
+    # with mosi_dlen at 23*8 - 1. The zeros just hold the strip in reset.
+    def _FindHost(self):
+        before = [h.mosi_dlen for h in spiHosts]
+        self.spi.write(bytes(23))
+        found = [i for i in range(len(spiHosts))
+                 if spiHosts[i].mosi_dlen == 23*8 - 1 and before[i] != 23*8 - 1]
+        if len(found) != 1:
+            return None
+        self.dmaChannel = found[0] + 1
+        return spiHosts[found[0]]
+
+    def _LowLevelInitDMA(self):
+        if not DPORT.perip_clk_en.spi_dma:
+            # First user of the SPI DMA, don't reset it under others later on
+            DPORT.perip_rst_en.spi_dma = 1
+            DPORT.perip_clk_en.spi_dma = 1
+            DPORT.perip_rst_en.spi_dma = 0
+        shift = 2 * self.dmaChannel
+        DPORT.spi_dma_chan_sel = DPORT.spi_dma_chan_sel & ~(3 << shift) | self.dmaChannel << shift
+
+    # Encode data, a list of pixel tuples or a PixelBuffer, into self.buf
+    # and return it.
+    def Encode(self, data):
+        n = (len(data) * 3 * self.bpp + RESET_BYTES + 3) & ~3
+        if self.buf is None or len(self.buf) != n:
+            self.buf = None
+            self.buf = bytearray(n)
+            self.shown = None
+        self._Fill(data, memoryview(self.buf), 0)
+        return self.buf
+
+    # Start sending data, a list of (red, green, blue[, white]) or a
+    # PixelBuffer, and return; the previous frame is waited for first.
+    def Display(self, data):
+        self.WaitSent()
+        buf = self.Encode(data)
+        if self.host is not None and self._linked is not buf:
+            self._Link()
+        if self.host is None:
+            self.spi.write(buf)
+            return
+        h = self.host
+        conf = h.dma_conf
+        h.dma_conf = conf | DMA_RESET
+        h.dma_conf = conf & ~DMA_RESET
+        h.phases = USR_MOSI
+        h.mosi_dlen = len(buf)*8 - 1
+        h.dma_out_link = self._outLink
+        h.usr = 1
+
+    # Build the descriptor chain over buf, or fall back to spi.write()
+    # when the DMA can't read it.
+    def _Link(self):
+        buf = self.buf
+        k = (len(buf) + DESC_MAX - 1) // DESC_MAX
+        self.desc = None
+        self.desc = bytearray(12 * k)
+        a = uctypes.addressof(buf)
+        d = uctypes.addressof(self.desc)
+        for addr in (a, a + len(buf) - 1, d):
+            if not DMA_RAM[0] <= addr < DMA_RAM[1]:
+                self.host = None
+                return
+        for i in range(k):
+            m = min(DESC_MAX, len(buf) - i*DESC_MAX)
+            last = i == k - 1
+            ustruct.pack_into("<III", self.desc, 12*i,
+                              1<<31 | (1<<30 if last else 0) | m<<12 | m,
+                              a + i*DESC_MAX,
+                              0 if last else d + 12*(i + 1))
+        self._outLink = d & 0xfffff | OUTLINK_START
+        self._linked = buf
+
+    # Wait until the frame started by Display() is sent.
+    def WaitSent(self):
+        if self.host is not None:
+            while self.host.usr:
+                pass
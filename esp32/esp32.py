@@ -65,9 +65,10 @@ TIMG_regs = {
     # divides APB clock (default 80MHz); only change when timer disabled
     # default is 1, which produces 2; 0 means 0x10000, others are verbatim.
     'edge_int_en': uctypes.BFUINT32 | 0x00 | 12<<uctypes.BF_POS | 1<<uctypes.BF_LEN, 
-    'level_int_en': uctypes.BFUINT32 | 0x00 | 12<<uctypes.BF_POS | 1<<uctypes.BF_LEN, 
-    'alarm_en': uctypes.BFUINT32 | 0x00 | 12<<uctypes.BF_POS | 1<<uctypes.BF_LEN, 
+    'level_int_en': uctypes.BFUINT32 | 0x00 | 11<<uctypes.BF_POS | 1<<uctypes.BF_LEN, 
+    'alarm_en': uctypes.BFUINT32 | 0x00 | 10<<uctypes.BF_POS | 1<<uctypes.BF_LEN, 
     # alarm and interrupts are disabled by default (continous counting)
+    # alarm_en is cleared by hardware when the alarm triggers
 
     'lo': uctypes.UINT32 | 0x04, 
     'hi': uctypes.UINT32 | 0x08, 
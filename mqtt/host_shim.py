@@ -0,0 +1,164 @@
+# Run the mqtt snippets under CPython: registers stand-ins for the
+# MicroPython modules they import. Import this module before any of the
+# mqtt_* modules.
+#
+# import host_shim
+# from mqtt_simple import MQTTClient
+import sys
+import types
+import socket as _socket
+import ssl as _ssl
+import select as _select
+import struct
+import binascii
+import time as _time
+
+
+# usocket.socket: MicroPython sockets are streams with read/write/readinto,
+# where blocking reads return the full requested length.
+class socket:
+
+    def __init__(self, af=_socket.AF_INET, type=_socket.SOCK_STREAM, proto=0, sock=None):
+        self.s = sock or _socket.socket(af, type, proto)
+        self.s.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+
+    def connect(self, addr):
+        self.s.connect(addr)
+
+    def setblocking(self, flag):
+        self.s.setblocking(flag)
+
+    def settimeout(self, t):
+        self.s.settimeout(t)
+
+    def fileno(self):
+        return self.s.fileno()
+
+    def close(self):
+        self.s.close()
+
+    def write(self, buf, n=None):
+        if n is not None:
+            buf = memoryview(buf)[:n]
+        self.s.sendall(buf)
+        return len(buf)
+
+    def readinto(self, buf, n=None):
+        mv = memoryview(buf)
+        if n is not None:
+            mv = mv[:n]
+        got = 0
+        while got < len(mv):
+            try:
+                r = self.s.recv_into(mv[got:])
+            except BlockingIOError:
+                return got or None
+            if not r:
+                break
+            got += r
+            if self.s.gettimeout() == 0.0:
+                break
+        return got
+
+    def read(self, n):
+        b = bytearray(n)
+        r = self.readinto(b)
+        if r is None:
+            return None
+        return bytes(b[:r])
+
+    def recv(self, n):
+        return self.s.recv(n)
+
+    def send(self, buf):
+        return self.s.send(buf)
+
+
+# ussl as on the Pycom port: wrap_socket() takes a saved_session from
+# save_session() for resumption. Sessions only resume with the context
+# that created them, so one client context is kept per parameter set.
+_ctx = {}
+
+
+def wrap_socket(sock, keyfile=None, certfile=None, server_side=False, cert_reqs=_ssl.CERT_NONE,
+                ca_certs=None, server_hostname=None, saved_session=None):
+    key = (keyfile, certfile, server_side, cert_reqs, ca_certs)
+    ctx = _ctx.get(key)
+    if ctx is None:
+        ctx = _ssl.SSLContext(_ssl.PROTOCOL_TLS_SERVER if server_side else _ssl.PROTOCOL_TLS_CLIENT)
+        ctx.check_hostname = False
+        ctx.verify_mode = cert_reqs
+        if ca_certs:
+            ctx.load_verify_locations(ca_certs)
+        if certfile:
+            ctx.load_cert_chain(certfile, keyfile)
+        _ctx[key] = ctx
+    s = ctx.wrap_socket(sock.s, server_side=server_side, server_hostname=server_hostname,
+                        session=saved_session)
+    res = socket(sock=s)
+    res.session_reused = s.session_reused
+    return res
+
+
+def save_session(sock):
+    return sock.s.session
+
+
+# uselect.poll: poll() returns the registered objects, not their fds.
+class poll:
+
+    def __init__(self):
+        self.p = _select.poll()
+        self.objs = {}
+
+    def register(self, obj, mask=_select.POLLIN | _select.POLLOUT):
+        self.objs[obj.fileno()] = obj
+        self.p.register(obj.fileno(), mask)
+
+    def modify(self, obj, mask):
+        self.p.modify(obj.fileno(), mask)
+
+    def unregister(self, obj):
+        fd = obj.fileno()
+        if fd < 0:
+            # Already closed, find it by object
+            for fd in self.objs:
+                if self.objs[fd] is obj:
+                    break
+            else:
+                return
+        del self.objs[fd]
+        self.p.unregister(fd)
+
+    def poll(self, timeout=-1):
+        return [(self.objs[fd], ev) for fd, ev in self.p.poll(timeout)]
+
+
+def _module(name, **attrs):
+    m = types.ModuleType(name)
+    m.__dict__.update(attrs)
+    sys.modules[name] = m
+    return m
+
+
+def install():
+    _module("usocket", socket=socket, getaddrinfo=_socket.getaddrinfo)
+    _module("ussl", wrap_socket=wrap_socket, save_session=save_session,
+            CERT_NONE=_ssl.CERT_NONE, CERT_OPTIONAL=_ssl.CERT_OPTIONAL,
+            CERT_REQUIRED=_ssl.CERT_REQUIRED)
+    _module("uselect", poll=poll, POLLIN=_select.POLLIN, POLLOUT=_select.POLLOUT,
+            POLLERR=_select.POLLERR, POLLHUP=_select.POLLHUP)
+    sys.modules["ustruct"] = struct
+    sys.modules["ubinascii"] = binascii
+    _module("utime",
+            ticks_ms=lambda: int(_time.monotonic() * 1000),
+            ticks_us=lambda: int(_time.monotonic() * 1000000),
+            ticks_diff=lambda a, b: a - b,
+            ticks_add=lambda a, b: a + b,
+            sleep=_time.sleep,
+            sleep_ms=lambda ms: _time.sleep(ms / 1000),
+            sleep_us=lambda us: _time.sleep(us / 1000000),
+            time=lambda: int(_time.time()))
+
+
+install()
@@ -0,0 +1,194 @@
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+from mqtt_simple import MQTTClient, MQTTException
+
+# asyncio flavour of MQTTClient: the packets are encoded by the
+# MQTTClient helpers, but the connection is an asyncio stream served by
+# a background reader task, so waiting on the broker never blocks the
+# event loop. Works with uasyncio (MicroPython) and CPython asyncio.
+#
+# async def main():
+#     c = AsyncMQTTClient(b"lopy", "broker", keepalive=60)
+#     await c.connect()
+#     await c.subscribe(b"cmd/#", 1)
+#     await c.publish(b"sensors/t1", b"21.5")
+#     async for topic, msg in c:
+#         print(topic, msg)
+#
+# QoS 0 and 1 are supported. TLS is not.
+
+class AsyncMQTTClient(MQTTClient):
+
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
+                 queue=16, resend_ms=5000):
+        MQTTClient.__init__(self, client_id, server, port, user, password, keepalive,
+                            resend_ms=resend_ms)
+        self.queue = queue
+        self._r = None
+        self._w = None
+        self._tasks = ()
+        self._err = None
+        self._alive = False
+        self._msgs = []
+        self._msg_ev = asyncio.Event()
+        # pid -> [Event, response]
+        self._waiting = {}
+
+    async def connect(self, clean_session=True):
+        self._r, self._w = await asyncio.open_connection(self.server, self.port)
+        await self._send(self._connect_pkt(clean_session))
+        present = self._connack(await self._r.readexactly(4))
+        self._err = None
+        self._alive = True
+        self._tasks = [asyncio.create_task(self._reader())]
+        if self.keepalive:
+            self._tasks.append(asyncio.create_task(self._keepalive()))
+        return present
+
+    async def disconnect(self):
+        try:
+            await self._send(b"\xe0\0")
+        finally:
+            self._close(OSError(-1))
+
+    async def ping(self):
+        await self._send(b"\xc0\0")
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        assert 0 <= qos <= 1
+        op = 0x30 | qos << 1 | retain
+        pid = self._new_pid() if qos else 0
+        sz = self._pub_size(op, topic, len(msg))
+        pkt = bytearray(sz + (2 if sz < 0x80 else 3 if sz < 0x4000 else 4 if sz < 0x200000 else 5))
+        self._pub_frame(pkt, op, sz, topic, msg, pid)
+        if not qos:
+            await self._send(pkt)
+            return
+        w = self._waiting[pid] = [asyncio.Event(), None]
+        try:
+            # Retransmit with DUP until the PUBACK arrives
+            while 1:
+                await self._send(pkt)
+                if await self._wait(w, self.resend_ms):
+                    return
+                pkt[0] |= 0x08
+        finally:
+            del self._waiting[pid]
+
+    async def subscribe(self, topic, qos=0):
+        assert 0 <= qos <= 1
+        pkt = self._subscribe_pkt(((topic, qos),))
+        pid = self.pid
+        w = self._waiting[pid] = [asyncio.Event(), None]
+        try:
+            await self._send(pkt)
+            await self._wait(w, None)
+        finally:
+            del self._waiting[pid]
+        if w[1][0] == 0x80:
+            raise MQTTException(w[1][0])
+
+    def __aiter__(self):
+        return self
+
+    # Yields (topic, msg) for each message received on subscribed
+    # topics. If more than `queue` messages are waiting, the oldest
+    # are dropped.
+    async def __anext__(self):
+        while not self._msgs:
+            if self._err is not None:
+                raise self._err
+            await self._msg_ev.wait()
+            self._msg_ev.clear()
+        return self._msgs.pop(0)
+
+    async def _send(self, pkt):
+        if self._err is not None:
+            raise self._err
+        self._w.write(pkt)
+        await self._w.drain()
+
+    # Wait for the response registered in _waiting, return False on
+    # timeout.
+    async def _wait(self, w, timeout_ms):
+        try:
+            if timeout_ms is None:
+                await w[0].wait()
+            else:
+                await asyncio.wait_for(w[0].wait(), timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            w[0].clear()
+            return False
+        if self._err is not None:
+            raise self._err
+        return True
+
+    def _close(self, err):
+        if self._err is None:
+            self._err = err
+        cur = asyncio.current_task()
+        for t in self._tasks:
+            if t is not cur:
+                t.cancel()
+        self._tasks = ()
+        if self._w is not None:
+            self._w.close()
+            self._w = None
+        # Wake up everything waiting on the connection
+        for w in self._waiting.values():
+            w[0].set()
+        self._msg_ev.set()
+
+    async def _reader(self):
+        r = self._r
+        try:
+            while 1:
+                op = (await r.readexactly(1))[0]
+                sz = 0
+                sh = 0
+                while 1:
+                    b = (await r.readexactly(1))[0]
+                    sz |= (b & 0x7f) << sh
+                    if not b & 0x80:
+                        break
+                    sh += 7
+                body = await r.readexactly(sz) if sz else b""
+                self._alive = True
+                if op & 0xf0 == 0x30:
+                    await self._recv(op, body)
+                elif op == 0x40 or op == 0x90:
+                    w = self._waiting.get(body[0] << 8 | body[1])
+                    if w is not None:
+                        w[1] = body[2:]
+                        w[0].set()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._close(OSError(-1))
+
+    async def _recv(self, op, body):
+        topic_len = body[0] << 8 | body[1]
+        topic = body[2:2 + topic_len]
+        i = 2 + topic_len
+        if op & 6:
+            pid = body[i] << 8 | body[i + 1]
+            i += 2
+            await self._send(bytes((0x40, 2, pid >> 8, pid & 0xff)))
+        if len(self._msgs) >= self.queue:
+            self._msgs.pop(0)
+        self._msgs.append((topic, body[i:]))
+        self._msg_ev.set()
+
+    # Send PINGREQ every keepalive/2 seconds. The link is considered
+    # dead if nothing, not even the PINGRESP, was received since the
+    # previous ping.
+    async def _keepalive(self):
+        while 1:
+            await asyncio.sleep(self.keepalive / 2)
+            if not self._alive:
+                self._close(OSError(-1))
+                return
+            self._alive = False
+            await self.ping()
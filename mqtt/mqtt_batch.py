@@ -0,0 +1,89 @@
+try:
+    import ustruct as struct
+    from utime import time
+except ImportError:
+    import struct
+    from time import time
+from mqtt_simple import ticks_ms, ticks_diff
+
+# Batch sensor readings into one compact binary MQTT message.
+#
+# b = ReadingBatch(c, b"sensors/batch", max_records=64, max_age_ms=30000)
+# while True:
+#     b.add_all(ds.read_temps())
+#     b.poll()
+#     c.check_msg()
+#
+# Payload layout (little endian):
+#   header (7 bytes): version (B), start time in seconds (I), scale (H)
+#   records (5 bytes each): ms since start (H), sensor index (B),
+#                           round(value * scale) (h)
+# Use decode() on the receiving side.
+
+VERSION = 1
+_HDR = "<BIH"
+_REC = "<HBh"
+_HDR_SZ = 7
+_REC_SZ = 5
+
+class ReadingBatch:
+
+    def __init__(self, client, topic, max_records=32, max_age_ms=60000, scale=100, qos=0):
+        assert max_age_ms <= 0xffff
+        self.client = client
+        self.topic = topic
+        self.max_age_ms = max_age_ms
+        self.scale = scale
+        self.qos = qos
+        self._buf = bytearray(_HDR_SZ + _REC_SZ * max_records)
+        self._n = 0
+        self._t0 = 0
+
+    # Add one reading, sending the batch first if it has grown too old or
+    # has no room left, and afterwards if it is full. A failed send keeps
+    # the batch for the next try and raises; when that happens before
+    # adding, the reading is not added.
+    def add(self, index, value):
+        now = ticks_ms()
+        if self._n and (ticks_diff(now, self._t0) > self.max_age_ms or
+                        _HDR_SZ + _REC_SZ * (self._n + 1) > len(self._buf)):
+            self.flush()
+        if not self._n:
+            self._t0 = now
+            struct.pack_into(_HDR, self._buf, 0, VERSION, int(time()), self.scale)
+        v = int(round(value * self.scale))
+        v = -0x8000 if v < -0x8000 else 0x7fff if v > 0x7fff else v
+        o = _HDR_SZ + _REC_SZ * self._n
+        struct.pack_into(_REC, self._buf, o, ticks_diff(now, self._t0), index, v)
+        self._n += 1
+        if o + 2 * _REC_SZ > len(self._buf):
+            self.flush()
+
+    # Add a list of readings, e.g. DS18X20.read_temps(), sensor i at
+    # index i.
+    def add_all(self, values):
+        for i in range(len(values)):
+            self.add(i, values[i])
+
+    # Send the batch if it reached max_age_ms. Call regularly.
+    def poll(self):
+        if self._n and ticks_diff(ticks_ms(), self._t0) >= self.max_age_ms:
+            self.flush()
+
+    def flush(self):
+        if not self._n:
+            return
+        sz = _HDR_SZ + _REC_SZ * self._n
+        self.client.publish(self.topic, bytes(self._buf[:sz]), qos=self.qos)
+        self._n = 0
+
+# Decode a batch payload into a list of (time in seconds, sensor index,
+# value).
+def decode(payload):
+    version, start, scale = struct.unpack_from(_HDR, payload, 0)
+    assert version == VERSION
+    res = []
+    for o in range(_HDR_SZ, len(payload) - _REC_SZ + 1, _REC_SZ):
+        ms, index, v = struct.unpack_from(_REC, payload, o)
+        res.append((start + ms / 1000, index, v / scale))
+    return res
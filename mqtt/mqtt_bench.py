@@ -0,0 +1,220 @@
+# Throughput/latency benchmarks for MQTTClient, run on the host:
+#
+#   python3 mqtt/mqtt_bench.py -o results.json
+#   python3 mqtt/mqtt_bench.py --compare results.json
+#
+# Uses host_shim to run the MicroPython code under CPython and a
+# StubBroker on a loopback socket. Reports msgs/s and p50/p99 latency in
+# microseconds for publish at QoS 0 and 1 (blocking and pipelined),
+# subscriber fan-in, and payload sizes from 8 B to 64 KB, each with the
+# default client and with the tx_buf/rx_buf buffers enabled. With --tls,
+# also connect() latency over TLS with full and resumed handshakes (needs
+# the openssl command for a throwaway certificate).
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import host_shim
+from mqtt_simple import MQTTClient
+from stub_broker import StubBroker, TLSStubBroker
+
+HOST = "127.0.0.1"
+SIZES = (8, 64, 512, 4096, 65536)
+CONFIGS = {
+    "default": {},
+    "buffered": {"tx_buf": 1024, "rx_buf": 4096},
+}
+
+
+def _stats(name, config, n, elapsed, lat_ns, **extra):
+    lat_ns = sorted(lat_ns)
+    res = {
+        "name": name,
+        "config": config,
+        "msgs": n,
+        "msgs_per_s": round(n / elapsed, 1),
+        "p50_us": round(lat_ns[len(lat_ns) // 2] / 1000, 1),
+        "p99_us": round(lat_ns[min(len(lat_ns) - 1, len(lat_ns) * 99 // 100)] / 1000, 1),
+    }
+    res.update(extra)
+    return res
+
+
+def _count(size, n):
+    # Keep the volume per case around 16 MB at most
+    return max(20, min(n, (16 << 20) // size))
+
+
+# Latency of each publish() call, i.e. until the PUBACK for blocking
+# QoS 1.
+def bench_publish(broker, config, qos, size, n, **opts):
+    kw = dict(CONFIGS[config], **opts)
+    c = MQTTClient(b"bench-pub", HOST, broker.port, **kw)
+    c.set_callback(lambda t, m: None)
+    c.connect()
+    topic = b"bench/pub"
+    msg = bytes(size)
+    lat = []
+    t0 = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter_ns()
+        c.publish(topic, msg, qos=qos)
+        lat.append(time.perf_counter_ns() - t)
+    c.wait_pending()
+    elapsed = time.perf_counter() - t0
+    c.disconnect()
+    name = "publish_qos%d" % qos
+    if opts.get("inflight"):
+        name += "_pipelined"
+    return _stats(name, config, n, elapsed, lat, size=size)
+
+
+# Several publishers feed one subscriber; latency is from publish() to
+# the subscriber's callback.
+def bench_fan_in(broker, config, publishers, size, n):
+    lat = []
+    done = threading.Event()
+    total = publishers * n
+
+    def cb(topic, msg):
+        lat.append(time.perf_counter_ns() - struct.unpack_from("<q", msg, 0)[0])
+        if len(lat) == total:
+            done.set()
+
+    sub = MQTTClient(b"bench-sub", HOST, broker.port, **CONFIGS[config])
+    sub.set_callback(cb)
+    sub.connect()
+    sub.subscribe(b"bench/fan/+")
+
+    def pub(i):
+        c = MQTTClient(b"bench-pub%d" % i, HOST, broker.port, **CONFIGS[config])
+        c.connect()
+        msg = bytearray(max(size, 8))
+        topic = b"bench/fan/%d" % i
+        for _ in range(n):
+            struct.pack_into("<q", msg, 0, time.perf_counter_ns())
+            c.publish(topic, msg)
+        c.disconnect()
+
+    threads = [threading.Thread(target=pub, args=(i,)) for i in range(publishers)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    while not done.is_set() and time.perf_counter() - t0 < 60:
+        sub.wait_msg()
+    elapsed = time.perf_counter() - t0
+    for t in threads:
+        t.join()
+    sub.disconnect()
+    return _stats("fan_in", config, len(lat), elapsed, lat, size=size, publishers=publishers)
+
+
+# connect() + disconnect() cycles over TLS, dropping the saved session
+# before each connect unless resume is set.
+def bench_connect_tls(broker, resume, n):
+    c = MQTTClient(b"bench-tls", HOST, broker.port, ssl=True)
+    lat = []
+    t0 = time.perf_counter()
+    for i in range(n):
+        if not resume:
+            c.tls_session = None
+        t = time.perf_counter_ns()
+        c.connect()
+        lat.append(time.perf_counter_ns() - t)
+        c.disconnect()
+    elapsed = time.perf_counter() - t0
+    name = "connect_tls_resumed" if resume else "connect_tls_full"
+    return _stats(name, "tls", n, elapsed, lat, full=c.tls_full, resumed=c.tls_resumed,
+                  offered=c.tls_offered)
+
+
+def run_tls(n):
+    with tempfile.TemporaryDirectory() as d:
+        cert = os.path.join(d, "cert.pem")
+        key = os.path.join(d, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                       check=True, stderr=subprocess.DEVNULL)
+        broker = TLSStubBroker(cert, key, HOST)
+    try:
+        return [bench_connect_tls(broker, False, n), bench_connect_tls(broker, True, n)]
+    finally:
+        broker.close()
+
+
+def run(n=2000, quick=False, tls=False):
+    if quick:
+        n = 200
+    broker = StubBroker(HOST)
+    results = []
+    try:
+        for config in CONFIGS:
+            for size in SIZES:
+                m = _count(size, n)
+                results.append(bench_publish(broker, config, 0, size, m))
+                results.append(bench_publish(broker, config, 1, size, max(20, m // 4)))
+                results.append(bench_publish(broker, config, 1, size, m, inflight=16))
+            results.append(bench_fan_in(broker, config, 4, 64, n // 4))
+    finally:
+        broker.close()
+    if tls:
+        results += run_tls(max(20, n // 20))
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "time": int(time.time()),
+        },
+        "results": results,
+    }
+
+
+def _key(r):
+    return (r["name"], r["config"], r.get("size"), r.get("publishers"))
+
+
+# Print the change of each case against a previous run, flagging
+# throughput drops over 10%.
+def compare(old, new):
+    prev = {_key(r): r for r in old["results"]}
+    for r in new["results"]:
+        o = prev.get(_key(r))
+        if o is None:
+            continue
+        ratio = r["msgs_per_s"] / o["msgs_per_s"]
+        flag = "  <-- regression" if ratio < 0.9 else ""
+        print("%-24s %-9s %6s  %10.1f -> %10.1f msgs/s (%+.0f%%)%s" % (
+            r["name"], r["config"], r.get("size", ""), o["msgs_per_s"],
+            r["msgs_per_s"], (ratio - 1) * 100, flag))
+
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("-n", type=int, default=2000, help="messages per case")
+    p.add_argument("-o", "--output", help="write results as JSON to this file")
+    p.add_argument("--compare", help="previous JSON results to compare with")
+    p.add_argument("--quick", action="store_true", help="short run")
+    p.add_argument("--tls", action="store_true", help="also benchmark TLS connect")
+    args = p.parse_args()
+    res = run(args.n, args.quick, args.tls)
+    for r in res["results"]:
+        print("%-24s %-9s %6s  %10.1f msgs/s  p50 %9.1f us  p99 %9.1f us" % (
+            r["name"], r["config"], r.get("size", ""), r["msgs_per_s"], r["p50_us"], r["p99_us"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(res, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), res)
+
+
+if __name__ == "__main__":
+    main()
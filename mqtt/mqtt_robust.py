@@ -0,0 +1,157 @@
+from mqtt_simple import MQTTClient, ticks_ms, ticks_diff
+
+# MQTTClient supervised from check_msg(): sends PINGREQ every
+# keepalive/2 seconds, treats a PINGREQ left unanswered until the next
+# one as a dead link, and reconnects with clean_session=False and
+# exponential backoff. While offline, publish() stores messages in a
+# fixed-size ring buffer (oldest dropped first, counted in .dropped)
+# which is flushed in order once the broker is reachable again.
+#
+# QoS 1/2 messages go through the in-flight window (inflight, 8 unless
+# given), so that neither publish() nor check_msg() waits for an
+# acknowledgement: messages that don't fit the window are queued too.
+#
+# c = RobustMQTTClient(b"lopy", "broker", keepalive=60, queue=32)
+# c.connect()
+# while True:
+#     c.publish(b"sensors/t1", read_temp())
+#     c.check_msg()
+
+class RobustMQTTClient(MQTTClient):
+
+    def __init__(self, client_id, server, queue=16, min_delay_ms=500, max_delay_ms=60000, **kw):
+        kw["inflight"] = kw.get("inflight") or 8
+        MQTTClient.__init__(self, client_id, server, **kw)
+        self.online = False
+        self.min_delay_ms = min_delay_ms
+        self.max_delay_ms = max_delay_ms
+        self._delay = min_delay_ms
+        self._wait = 0
+        self._fail_t = 0
+        self._ping_t = 0
+        self._q = [None] * queue
+        self._qh = 0
+        self._qn = 0
+        self.dropped = 0
+
+    def connect(self, clean_session=False):
+        try:
+            res = MQTTClient.connect(self, clean_session)
+        except Exception:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+            raise
+        self.online = True
+        self._delay = self.min_delay_ms
+        self._ping_t = ticks_ms()
+        return res
+
+    def disconnect(self):
+        self.online = False
+        MQTTClient.disconnect(self)
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if self.online and not self._qn and (not qos or self._ifl_room()):
+            n = self._ifl_n
+            try:
+                return MQTTClient.publish(self, topic, msg, retain, qos)
+            except OSError:
+                self._lost()
+                if self._ifl_n > n:
+                    # In the window already, resent after the reconnect
+                    return None
+        self._enqueue((topic, msg, retain, qos))
+        self._flush()
+
+    def wait_msg(self):
+        try:
+            return MQTTClient.wait_msg(self)
+        except OSError:
+            self._lost()
+            raise
+
+    # Drive the connection: reconnect when due, send keepalive pings,
+    # flush queued messages and process one incoming packet. Never
+    # raises on network errors.
+    def check_msg(self):
+        if not self.online:
+            self._reconnect()
+            if not self.online:
+                return None
+        try:
+            self._keepalive()
+            self._flush()
+            if not self.online:
+                return None
+            return MQTTClient.check_msg(self)
+        except OSError:
+            self._lost()
+            return None
+
+    # Number of messages waiting in the offline buffer.
+    def queued(self):
+        return self._qn
+
+    def _keepalive(self):
+        if not self.keepalive:
+            return
+        now = ticks_ms()
+        if ticks_diff(now, self._ping_t) >= self.keepalive * 500:
+            if self.pings:
+                raise OSError(-1)
+            self._ping_t = now
+            self.ping()
+
+    def _lost(self):
+        if not self.online:
+            return
+        self.online = False
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self._delay = self.min_delay_ms
+        self._wait = 0
+
+    def _reconnect(self):
+        now = ticks_ms()
+        if ticks_diff(now, self._fail_t) < self._wait:
+            return
+        try:
+            self.connect(False)
+        except Exception:
+            self._fail_t = now
+            self._wait = self._delay
+            self._delay = min(self._delay * 2, self.max_delay_ms)
+
+    def _enqueue(self, item):
+        n = len(self._q)
+        if self._qn == n:
+            self._q[self._qh] = None
+            self._qh = (self._qh + 1) % n
+            self._qn -= 1
+            self.dropped += 1
+        self._q[(self._qh + self._qn) % n] = item
+        self._qn += 1
+
+    def _ifl_room(self):
+        return self._ifl_n < len(self._ifl_pid)
+
+    # Publish queued messages while the in-flight window has room.
+    def _flush(self):
+        while self.online and self._qn:
+            topic, msg, retain, qos = self._q[self._qh]
+            if qos and not self._ifl_room():
+                return
+            n = self._ifl_n
+            try:
+                MQTTClient.publish(self, topic, msg, retain, qos)
+            except OSError:
+                self._lost()
+                if self._ifl_n == n:
+                    return
+            # Sent, or in the window to be resent after the reconnect
+            self._q[self._qh] = None
+            self._qh = (self._qh + 1) % len(self._q)
+            self._qn -= 1
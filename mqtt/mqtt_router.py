@@ -0,0 +1,87 @@
+# Per-filter message dispatch for MQTTClient.
+#
+# Handlers are stored in a trie keyed by topic level, so dispatching a
+# message costs O(topic depth) whatever the number of filters, and the
+# "+" and "#" wildcards are handled as in the broker.
+#
+# r = TopicRouter()
+# r.add(b"sensors/+/temp", on_temp)
+# r.add(b"cmd/#", on_cmd)
+# c.set_callback(r)
+# c.subscribe_many([(f, 1) for f in r.filters()])
+
+class TopicRouter:
+
+    def __init__(self):
+        # node = {level: child node, None: [handlers]}
+        self.root = {}
+
+    def add(self, topic_filter, handler):
+        node = self.root
+        for level in topic_filter.split(b"/"):
+            node = node.setdefault(level, {})
+        node.setdefault(None, []).append(handler)
+
+    def remove(self, topic_filter, handler=None):
+        path = [self.root]
+        for level in topic_filter.split(b"/"):
+            node = path[-1].get(level)
+            if node is None:
+                return
+            path.append(node)
+        handlers = path[-1].get(None)
+        if handlers and handler in handlers:
+            handlers.remove(handler)
+        if handler is None or not handlers:
+            path[-1].pop(None, None)
+        # Prune the branches left empty
+        levels = topic_filter.split(b"/")
+        for i in range(len(levels), 0, -1):
+            if path[i]:
+                break
+            del path[i - 1][levels[i - 1]]
+
+    def filters(self):
+        res = []
+        # prefix is None at the root: b"" is the empty first level of a
+        # filter like b"/a"
+        stack = [(self.root, None)]
+        while stack:
+            node, prefix = stack.pop()
+            for level, child in node.items():
+                if level is None:
+                    res.append(prefix)
+                else:
+                    stack.append((child, level if prefix is None else prefix + b"/" + level))
+        return res
+
+    # MQTTClient callback: call every handler whose filter matches the
+    # topic. Returns the number of handlers called.
+    def __call__(self, topic, msg):
+        levels = bytes(topic).split(b"/")
+        # Wildcards don't match topics starting with "$" (e.g. $SYS)
+        return self._match(self.root, levels, 0, topic, msg, levels[0][:1] != b"$")
+
+    def _match(self, node, levels, i, topic, msg, wild):
+        n = 0
+        child = node.get(b"#") if wild else None
+        if child is not None:
+            # "a/#" also matches "a"
+            n += self._call(child, topic, msg)
+        if i == len(levels):
+            return n + self._call(node, topic, msg)
+        child = node.get(levels[i])
+        if child is not None:
+            n += self._match(child, levels, i + 1, topic, msg, True)
+        child = node.get(b"+") if wild else None
+        if child is not None:
+            n += self._match(child, levels, i + 1, topic, msg, True)
+        return n
+
+    def _call(self, node, topic, msg):
+        handlers = node.get(None)
+        if not handlers:
+            return 0
+        for h in handlers:
+            h(topic, msg)
+        return len(handlers)
@@ -1,23 +1,127 @@
-import usocket as socket
-import ustruct as struct
-from ubinascii import hexlify
+try:
+    import usocket as socket
+    import uselect as select
+    import ustruct as struct
+    from ubinascii import hexlify
+    from utime import ticks_ms, ticks_diff, ticks_add, time
+except ImportError:
+    # CPython, for the packet code shared with mqtt_async
+    import socket
+    import select
+    import struct
+    from binascii import hexlify
+    from time import monotonic, time
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+    def ticks_add(a, b):
+        return a + b
 
 class MQTTException(Exception):
     pass
 
+# Resolved broker addresses: "server:port" -> [ip, expiry time]
+_dns = {}
+
+def _dns_load(path):
+    try:
+        with open(path) as f:
+            for line in f:
+                key, ip, exp = line.split()
+                _dns.setdefault(key, [ip, int(exp)])
+    except (OSError, ValueError):
+        pass
+
+def _dns_save(path):
+    try:
+        with open(path, "w") as f:
+            for key, e in _dns.items():
+                f.write("%s %s %d\n" % (key, e[0], e[1]))
+    except OSError:
+        pass
+
+# A topic encoded once for repeated publishing, see MQTTClient.topic().
+class Topic:
+
+    def __init__(self, name):
+        self.name = name
+        # Length-prefixed topic, as it appears in a PUBLISH packet
+        self.enc = struct.pack("!H", len(name)) + name
+        self.size = len(self.enc)
+
+# Payload of an incoming message being streamed to the callback set with
+# MQTTClient.set_stream_callback(). Reads stop at the end of the payload.
+class PayloadReader:
+
+    def __init__(self, client):
+        self._c = client
+        # Payload bytes not read yet
+        self.left = 0
+        self._skip = bytearray(64)
+
+    def readinto(self, buf, n=-1):
+        if n < 0 or n > len(buf):
+            n = len(buf)
+        if n > self.left:
+            n = self.left
+        if not n:
+            return 0
+        n = self._c._readinto(buf, n)
+        self.left -= n
+        return n
+
+    def read(self, n=-1):
+        if n < 0 or n > self.left:
+            n = self.left
+        self.left -= n
+        return self._c._read(n)
+
+    # Discard the rest of the payload.
+    def skip(self):
+        while self.readinto(self._skip):
+            pass
+
 class MQTTClient:
 
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
-                 ssl=False, ssl_params={}):
+                 ssl=False, ssl_params={}, tx_buf=0,
+                 rx_buf=0, inflight=0, resend_ms=5000, rx_qos2=20, dns_ttl=3600, dns_cache=None):
         if port == 0:
             port = 8883 if ssl else 1883
+        self.server = server
+        self.port = port
         self.client_id = client_id
         self.sock = None
-        self.addr = socket.getaddrinfo(server, port)[0][-1]
+        # The server name is resolved by connect(), through a cache
+        # keeping addresses for dns_ttl seconds. With dns_cache set to a
+        # file path (e.g. on /flash), the cache survives deep sleep.
+        self.addr = None
+        self.dns_ttl = dns_ttl
+        self.dns_cache = dns_cache
+        self._dns_hit = False
         self.ssl = ssl
         self.ssl_params = ssl_params
+        # TLS session saved after each connect and offered on the next
+        # one for an abbreviated handshake. Lives in RAM only: the port's
+        # session objects can't be written to flash, so it carries over
+        # reconnects and light sleep but not deep sleep.
+        self.tls_session = None
+        # Handshakes done in full and resumed, handshakes with a session
+        # offered where the port can't tell whether it was resumed
+        # (no session_reused), duration of the last connect() in ms
+        self.tls_full = 0
+        self.tls_resumed = 0
+        self.tls_offered = 0
+        self.connect_ms = 0
         self.pid = 0
         self.cb = None
+        self._scb = None
+        self._smin = 0
+        self._sreader = None
         self.user = user
         self.pswd = password
         self.keepalive = keepalive
@@ -25,16 +129,108 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        self._topics = {}
+        self._sbuf = None
+        # PINGREQs sent since the last PINGRESP
+        self.pings = 0
+        # Optional preallocated buffer: PUBLISH packets that fit are
+        # assembled here and sent with a single write.
+        self.txbuf = bytearray(tx_buf) if tx_buf else None
+        # Optional preallocated receive buffer: incoming packets are read
+        # into it in bulk and PUBLISH frames are passed to the callback
+        # as memoryview slices, valid only for the duration of the call.
+        self.rxbuf = None
+        if rx_buf:
+            assert rx_buf >= 16
+            self.rxbuf = bytearray(rx_buf)
+            self._rxmv = memoryview(self.rxbuf)
+        self._rpos = 0
+        self._rend = 0
+        self._nb = False
+        # In-flight window for QoS 1 (non-blocking if inflight > 0) and
+        # QoS 2 publishes. Slot i is free when _ifl_pid[i] is 0, _ifl_op[i]
+        # holds the header byte of the packet to retransmit: the PUBLISH
+        # while waiting for PUBACK/PUBREC, PUBREL while waiting for PUBCOMP.
+        # _rx_pid holds ids of received QoS 2 messages awaiting PUBREL,
+        # rx_qos2 of them: at least the broker's limit of messages in
+        # flight per client (max_inflight_messages, 20 on mosquitto).
+        self.inflight = inflight
+        self.resend_ms = resend_ms
+        n = inflight or 1
+        self._ifl_n = 0
+        self._ifl_pid = [0] * n
+        self._ifl_op = [0] * n
+        self._ifl_t = [0] * n
+        self._ifl_topic = [None] * n
+        self._ifl_msg = [None] * n
+        # No in-flight packet is due for retransmission before this time
+        self._ifl_due = 0
+        self._rx_pid = [0] * rx_qos2
+        # QoS 2 messages received with _rx_pid full, see _rx_new()
+        self.rx_overflow = 0
+        # poll() object for the current socket, see _ifl_wait()
+        self._poller = None
+        self._psock = None
+        self._ack = bytearray(b"\0\x02\0\0")
 
     def _send_str(self, s):
         self.sock.write(struct.pack("!H", len(s)))
         self.sock.write(s)
 
+    def _read(self, n):
+        if self._rpos == self._rend:
+            return self.sock.read(n)
+        # Serve buffered bytes first, then the rest from the socket
+        p = self._rpos
+        avail = self._rend - p
+        if avail >= n:
+            self._rpos = p + n
+            return bytes(self._rxmv[p:p + n])
+        res = bytes(self._rxmv[p:self._rend])
+        self._rpos = self._rend = 0
+        return res + self.sock.read(n - avail)
+
+    # Read up to n bytes into buf, buffered bytes first. Returns the
+    # count, which is short only at the end of the buffered data.
+    def _readinto(self, buf, n):
+        p = self._rpos
+        avail = self._rend - p
+        if not avail:
+            n = self.sock.readinto(buf, n)
+            if not n:
+                raise OSError(-1)
+            return n
+        if avail > n:
+            avail = n
+        buf[:avail] = self._rxmv[p:p + avail]
+        self._rpos = p + avail
+        return avail
+
+    # Make sure at least need bytes from _rpos are in the receive buffer.
+    def _fill(self, need):
+        b = self.rxbuf
+        p = self._rpos
+        if p + need > len(b):
+            # Move the partial frame to the start of the buffer
+            n = self._rend - p
+            if n > p:
+                for i in range(n):
+                    b[i] = b[p + i]
+            else:
+                self._rxmv[:n] = self._rxmv[p:p + n]
+            self._rpos = 0
+            self._rend = n
+        while self._rend - self._rpos < need:
+            n = self.sock.readinto(self._rxmv[self._rend:], need - self._rend + self._rpos)
+            if not n:
+                raise OSError(-1)
+            self._rend += n
+
     def _recv_len(self):
         n = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
+            b = self._read(1)[0]
             n |= (b & 0x7f) << sh
             if not b & 0x80:
                 return n
@@ -43,6 +239,18 @@ class MQTTClient:
     def set_callback(self, f):
         self.cb = f
 
+    # Deliver incoming PUBLISH packets with a remaining length of at
+    # least min_size bytes to f(topic, length, reader) instead of the
+    # set_callback() function, without buffering the payload: reader is
+    # a PayloadReader with read() and readinto() limited to the length
+    # bytes of payload, e.g. to copy it to a file or feed a parser.
+    # Whatever f leaves unread is discarded. f=None disables streaming.
+    def set_stream_callback(self, f, min_size=0):
+        self._scb = f
+        self._smin = min_size
+        if self._sreader is None:
+            self._sreader = PayloadReader(self)
+
     def set_last_will(self, topic, msg, retain=False, qos=0):
         assert 0 <= qos <= 2
         assert topic
@@ -51,12 +259,7 @@ class MQTTClient:
         self.lw_qos = qos
         self.lw_retain = retain
 
-    def connect(self, clean_session=True):
-        self.sock = socket.socket()
-        self.sock.connect(self.addr)
-        if self.ssl:
-            import ussl
-            self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
+    def _connect_pkt(self, clean_session):
         msg = bytearray(b"\x10\0\0\x04MQTT\x04\x02\0\0")
         msg[1] = 10 + 2 + len(self.client_id)
         msg[9] = clean_session << 1
@@ -71,89 +274,446 @@ class MQTTClient:
             msg[1] += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
             msg[9] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
             msg[9] |= self.lw_retain << 5
-        self.sock.write(msg)
         #print(hex(len(msg)), hexlify(msg, ":"))
-        self._send_str(self.client_id)
+        strs = [self.client_id]
         if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
+            strs += (self.lw_topic, self.lw_msg)
         if self.user is not None:
-            self._send_str(self.user)
-            self._send_str(self.pswd)
-        resp = self.sock.read(4)
+            strs += (self.user, self.pswd)
+        for s in strs:
+            msg += struct.pack("!H", len(s))
+            msg += s
+        return msg
+
+    def _connack(self, resp):
         assert resp[0] == 0x20 and resp[1] == 0x02
         if resp[3] != 0:
             raise MQTTException(resp[3])
         return resp[2] & 1
 
+    def _resolve(self, fresh):
+        key = "%s:%d" % (self.server, self.port)
+        now = time()
+        e = _dns.get(key)
+        if e is None and self.dns_cache:
+            _dns_load(self.dns_cache)
+            e = _dns.get(key)
+        self._dns_hit = not fresh and e is not None and e[1] > now
+        if self._dns_hit:
+            # Numeric address, no DNS query
+            return socket.getaddrinfo(e[0], self.port)[0][-1]
+        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        if type(addr) is tuple and self.dns_ttl:
+            _dns[key] = [addr[0], int(now) + self.dns_ttl]
+            if self.dns_cache:
+                _dns_save(self.dns_cache)
+        return addr
+
+    def connect(self, clean_session=True):
+        t = ticks_ms()
+        # Resolve first: a DNS failure then leaves no socket behind
+        self.addr = self._resolve(False)
+        self.sock = socket.socket()
+        try:
+            self.sock.connect(self.addr)
+        except OSError:
+            if not self._dns_hit:
+                raise
+            # The broker may have moved, retry with a fresh lookup
+            self.sock.close()
+            self.sock = None
+            self.addr = self._resolve(True)
+            self.sock = socket.socket()
+            self.sock.connect(self.addr)
+        if self.ssl:
+            self._wrap_ssl()
+        self._rpos = self._rend = 0
+        self._nb = False
+        self.pings = 0
+        self.sock.write(self._connect_pkt(clean_session))
+        present = self._connack(self.sock.read(4))
+        if clean_session or not present:
+            # The broker has no state for our packet ids: forget the
+            # received QoS 2 ids, and with a clean session the publishes
+            # in flight. Otherwise those are resent, as new messages for
+            # the broker.
+            for i in range(len(self._rx_pid)):
+                self._rx_pid[i] = 0
+            if clean_session:
+                for i in range(len(self._ifl_pid)):
+                    self._ifl_pid[i] = 0
+                    self._ifl_topic[i] = self._ifl_msg[i] = None
+                self._ifl_n = 0
+        if self.ssl:
+            self._save_session()
+        self.connect_ms = ticks_diff(ticks_ms(), t)
+        return present
+
+    def _wrap_ssl(self):
+        import ussl
+        params = self.ssl_params
+        if self.tls_session is not None:
+            params = dict(params, saved_session=self.tls_session)
+        try:
+            self.sock = ussl.wrap_socket(self.sock, **params)
+        except Exception:
+            # Maybe the session is no longer accepted, go for a full
+            # handshake next time
+            self.tls_session = None
+            raise
+        reused = getattr(self.sock, "session_reused", None)
+        if self.tls_session is None or reused is False:
+            self.tls_full += 1
+        elif reused:
+            self.tls_resumed += 1
+        else:
+            self.tls_offered += 1
+
+    def _save_session(self):
+        import ussl
+        if hasattr(ussl, "save_session"):
+            # After the CONNACK, as TLS 1.3 servers send tickets late
+            self.tls_session = ussl.save_session(self.sock)
+
     def disconnect(self):
         self.sock.write(b"\xe0\0")
         self.sock.close()
 
     def ping(self):
         self.sock.write(b"\xc0\0")
+        self.pings += 1
 
-    def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
-        if qos > 0:
-            sz += 2
-        assert sz < 2097152
+    def _new_pid(self):
+        pid = self.pid % 65535 + 1
+        while pid in self._ifl_pid:
+            pid = pid % 65535 + 1
+        self.pid = pid
+        return pid
+
+    def _pub_header(self, pkt, op, sz):
+        pkt[0] = op
         i = 1
         while sz > 0x7f:
             pkt[i] = (sz & 0x7f) | 0x80
             sz >>= 7
             i += 1
         pkt[i] = sz
+        return i + 1
+
+    # Assemble a complete PUBLISH packet into buf, return its length.
+    def _pub_frame(self, buf, op, sz, topic, msg, pid):
+        i = self._pub_header(buf, op, sz)
+        if type(topic) is Topic:
+            n = topic.size
+            buf[i:i + n] = topic.enc
+        else:
+            n = len(topic)
+            buf[i] = n >> 8
+            buf[i + 1] = n & 0xff
+            buf[i + 2:i + 2 + n] = topic
+            n += 2
+        i += n
+        if op & 6:
+            buf[i] = pid >> 8
+            buf[i + 1] = pid & 0xff
+            i += 2
+        n = len(msg)
+        buf[i:i + n] = msg
+        return i + n
+
+    # Remaining length of a PUBLISH packet with an n byte payload
+    def _pub_size(self, op, topic, n):
+        if type(topic) is Topic:
+            sz = topic.size + n
+        else:
+            sz = 2 + len(topic) + n
+        if op & 6:
+            sz += 2
+        assert sz < 268435456
+        return sz
+
+    def _send_publish(self, op, topic, msg, pid):
+        sz = self._pub_size(op, topic, len(msg))
+        buf = self.txbuf
+        if buf is not None and sz + 5 <= len(buf):
+            self.sock.write(buf, self._pub_frame(buf, op, sz, topic, msg, pid))
+            return
+        self._send_pub_head(op, sz, topic, pid)
+        self.sock.write(msg)
+
+    # Send everything in a PUBLISH packet up to the payload
+    def _send_pub_head(self, op, sz, topic, pid):
+        pkt = bytearray(5)
         #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
-        if qos > 0:
-            self.pid += 1
-            pid = self.pid
+        self.sock.write(pkt, self._pub_header(pkt, op, sz))
+        if type(topic) is Topic:
+            self.sock.write(topic.enc)
+        else:
+            self._send_str(topic)
+        if op & 6:
             struct.pack_into("!H", pkt, 0, pid)
             self.sock.write(pkt, 2)
-        self.sock.write(msg)
+
+    # Return a Topic handle for name, to be passed to publish() in place
+    # of the name. Its length prefix is encoded once instead of on every
+    # publish. Handles are interned per client.
+    def topic(self, name):
+        t = self._topics.get(name)
+        if t is None:
+            t = self._topics[name] = Topic(name)
+        return t
+
+    # With inflight > 0, QoS 1 and QoS 2 publishes don't wait for the
+    # end of their handshake. They return the packet id once sent;
+    # acknowledgements are matched by wait_msg()/check_msg(), which also
+    # retransmit unacknowledged packets after resend_ms. If the window
+    # is full, publish() blocks processing incoming packets until a slot
+    # is freed.
+    # With inflight == 0, QoS 2 publishes block until PUBCOMP.
+    def publish(self, topic, msg, retain=False, qos=0):
+        op = 0x30 | qos << 1 | retain
+        pid = 0
+        if qos > 0:
+            pid = self._new_pid()
+        if qos == 2 or qos == 1 and self.inflight:
+            i = self._ifl_add(pid, op, topic, msg)
+            self._send_publish(op, topic, msg, pid)
+            if not self.inflight:
+                while self._ifl_pid[i] == pid:
+                    self.wait_msg()
+            return pid
+        self._send_publish(op, topic, msg, pid)
         if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
+            self._wait_puback(pid)
 
-    def subscribe(self, topic, qos=0):
-        assert self.cb is not None, "Subscribe callback is not set"
+    # Publish a payload of `length` bytes taken from reader: an object
+    # with readinto() such as a file, or an iterable of bytes-like chunks
+    # such as a generator. Payloads are copied through one chunk sized
+    # buffer and may be up to the 256 MB MQTT limit. QoS 0 or 1; QoS 1
+    # waits for the PUBACK as the payload can't be retransmitted.
+    def publish_stream(self, topic, reader, length, retain=False, qos=0, chunk=512):
+        assert 0 <= qos <= 1
+        op = 0x30 | qos << 1 | retain
+        pid = 0
+        i = -1
+        if qos:
+            pid = self._new_pid()
+            if self.inflight:
+                i = self._ifl_add(pid, op, topic, None)
+        try:
+            self._send_stream(op, topic, reader, length, pid, chunk)
+            if i >= 0:
+                while self._ifl_pid[i] == pid:
+                    self.wait_msg()
+            elif qos:
+                self._wait_puback(pid)
+        finally:
+            # The payload can't be resent: after any error the slot
+            # would never be acknowledged
+            if i >= 0 and self._ifl_pid[i] == pid:
+                self._ifl_free(i)
+
+    def _send_stream(self, op, topic, reader, length, pid, chunk):
+        self._send_pub_head(op, self._pub_size(op, topic, length), topic, pid)
+        left = length
+        if hasattr(reader, "readinto"):
+            if self._sbuf is None or len(self._sbuf) != chunk:
+                self._sbuf = bytearray(chunk)
+            buf = self._sbuf
+            mv = memoryview(buf)
+            while left:
+                n = reader.readinto(mv[:left] if left < chunk else mv)
+                if not n:
+                    break
+                self.sock.write(buf, n)
+                left -= n
+        else:
+            for data in reader:
+                if len(data) > left:
+                    left = -1
+                    break
+                self.sock.write(data)
+                left -= len(data)
+        if left:
+            # The packet on the wire is now malformed
+            self.sock.close()
+            raise ValueError("payload length mismatch")
+
+    def _wait_puback(self, pid):
+        while 1:
+            op = self.wait_msg()
+            if op == 0x40:
+                sz = self._read(1)
+                assert sz == b"\x02"
+                rcv_pid = self._read(2)
+                rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
+                if pid == rcv_pid:
+                    return
+
+    def _ifl_slot(self):
+        while self._ifl_n == len(self._ifl_pid):
+            self._ifl_wait()
+        return self._ifl_pid.index(0)
+
+    # Sleep in poll() until a packet arrives or the oldest in-flight
+    # packet is due for retransmission, then process the packet and/or
+    # retransmit. The deadline also catches bytes a TLS socket has
+    # decrypted already, which poll() may not report.
+    def _ifl_wait(self):
+        # Also with steady incoming traffic, which never lets poll() time out
+        self._resend_due()
+        if not self.buffered():
+            if self._psock is not self.sock:
+                self._poller = select.poll()
+                self._poller.register(self.sock, select.POLLIN)
+                self._psock = self.sock
+            ready = self._poller.poll(0)
+            if not ready:
+                ms = ticks_diff(self._ifl_due, ticks_ms())
+                ready = ms > 0 and self._poller.poll(ms)
+            if ready and self.rxbuf is None:
+                # A blocking read saves the setblocking() calls
+                self.wait_msg()
+                return
+        # Not a subclass's check_msg(), which may reconnect
+        MQTTClient.check_msg(self)
+        # Acknowledgements come in bursts, take all that were read
+        while self.buffered():
+            self.wait_msg()
+
+    # Block until every QoS 1/2 publish in flight is acknowledged,
+    # retransmitting as needed.
+    def wait_pending(self):
+        while self._ifl_n:
+            self._ifl_wait()
+
+    def _ifl_add(self, pid, op, topic, msg):
+        i = self._ifl_slot()
+        self._ifl_pid[i] = pid
+        self._ifl_op[i] = op
+        self._ifl_t[i] = ticks_ms()
+        self._ifl_topic[i] = topic
+        self._ifl_msg[i] = msg
+        if not self._ifl_n:
+            # Later entries are due after this one
+            self._ifl_due = ticks_add(self._ifl_t[i], self.resend_ms)
+        self._ifl_n += 1
+        return i
+
+    def _ifl_free(self, i):
+        self._ifl_pid[i] = 0
+        self._ifl_topic[i] = self._ifl_msg[i] = None
+        self._ifl_n -= 1
+
+    # Number of QoS 1/2 publishes whose handshake is not complete.
+    def pending(self):
+        return self._ifl_n
+
+    # Retransmit in-flight packets that were not acknowledged within
+    # resend_ms: PUBLISH with the DUP flag, or PUBREL. Called from
+    # check_msg().
+    def resend(self):
+        now = ticks_ms()
+        due = self.resend_ms
+        for i in range(len(self._ifl_pid)):
+            pid = self._ifl_pid[i]
+            if not pid:
+                continue
+            age = ticks_diff(now, self._ifl_t[i])
+            if age >= self.resend_ms:
+                self._ifl_t[i] = now
+                age = 0
+                op = self._ifl_op[i]
+                if op == 0x62:
+                    self._send_ack(op, pid)
+                elif self._ifl_msg[i] is not None:
+                    self._send_publish(op | 0x08, self._ifl_topic[i], self._ifl_msg[i], pid)
+            due = min(due, self.resend_ms - age)
+        self._ifl_due = ticks_add(now, due)
+
+    # resend() if a retransmission may be due.
+    def _resend_due(self):
+        if self._ifl_n and ticks_diff(ticks_ms(), self._ifl_due) >= 0:
+            self.resend()
+
+    def _send_ack(self, op, pid):
+        pkt = self._ack
+        pkt[0] = op
+        pkt[2] = pid >> 8
+        pkt[3] = pid & 0xff
+        self.sock.write(pkt)
+
+    # Handle an incoming acknowledgement belonging to the QoS 1/2
+    # state machines, otherwise return its type to the caller.
+    def _ctrl(self, op):
+        if op not in (0x40, 0x50, 0x62, 0x70) or op == 0x40 and not self.inflight:
+            return op
+        resp = self._read(3)
+        assert resp[0] == 2
+        pid = resp[1] << 8 | resp[2]
+        if op == 0x62:  # PUBREL for a received QoS 2 message
+            if pid in self._rx_pid:
+                self._rx_pid[self._rx_pid.index(pid)] = 0
+            self._send_ack(0x70, pid)
+            return None
+        if op == 0x50:  # PUBREC, answer with PUBREL
+            self._send_ack(0x62, pid)
+        if pid not in self._ifl_pid:
+            return None
+        i = self._ifl_pid.index(pid)
+        if op == 0x50:
+            # Now waiting for PUBCOMP, the message itself is not needed
+            self._ifl_op[i] = 0x62
+            self._ifl_t[i] = ticks_ms()
+            self._ifl_topic[i] = self._ifl_msg[i] = None
+        else:  # PUBACK or PUBCOMP, handshake complete
+            self._ifl_free(i)
+        return None
+
+    def _subscribe_pkt(self, topics):
+        sz = 2
+        for topic, qos in topics:
+            sz += 2 + len(topic) + 1
         pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
+        del pkt[self._pub_header(pkt, 0x82, sz):]
+        pkt += struct.pack("!H", self._new_pid())
+        for topic, qos in topics:
+            pkt += struct.pack("!H", len(topic))
+            pkt += topic
+            pkt.append(qos)
         #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
+        return pkt
+
+    def subscribe(self, topic, qos=0):
+        if self.subscribe_many(((topic, qos),))[0] == 0x80:
+            raise MQTTException(0x80)
+
+    # Subscribe to several (topic, qos) filters with a single SUBSCRIBE
+    # packet. Returns the SUBACK return codes, one per filter: the
+    # granted QoS or 0x80 for failure.
+    def subscribe_many(self, topics):
+        assert self.cb is not None, "Subscribe callback is not set"
+        self.sock.write(self._subscribe_pkt(topics))
+        pid = self.pid
         while 1:
             op = self.wait_msg()
             if op == 0x90:
-                resp = self.sock.read(4)
+                resp = self._read(self._recv_len())
                 #print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
-                return
+                assert resp[0] << 8 | resp[1] == pid
+                return resp[2:]
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
+        if self.rxbuf is not None:
+            return self._wait_msg_buf()
         res = self.sock.read(1)
-        self.sock.setblocking(True)
+        if self._nb:
+            self.sock.setblocking(True)
+            self._nb = False
         if res is None:
             return None
         if res == b"":
@@ -161,31 +721,145 @@ class MQTTClient:
         if res == b"\xd0":  # PINGRESP
             sz = self.sock.read(1)[0]
             assert sz == 0
+            self.pings = 0
             return None
         op = res[0]
         if op & 0xf0 != 0x30:
-            return op
+            return self._ctrl(op)
         sz = self._recv_len()
-        topic_len = self.sock.read(2)
+        self._recv_publish(op, sz)
+
+    def _recv_publish(self, op, sz):
+        stream = self._scb is not None and sz >= self._smin
+        topic_len = self._read(2)
         topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
+        topic = self._read(topic_len)
         sz -= topic_len + 2
+        pid = 0
         if op & 6:
-            pid = self.sock.read(2)
+            pid = self._read(2)
             pid = pid[0] << 8 | pid[1]
             sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
+        if stream:
+            self._stream(op, topic, sz, pid)
+            return
+        msg = self._read(sz)
+        if op & 6 != 4 or self._rx_new(pid):
+            self.cb(topic, msg)
+        self._puback(op, pid)
+
+    def _stream(self, op, topic, sz, pid):
+        r = self._sreader
+        r.left = sz
+        try:
+            if op & 6 != 4 or self._rx_new(pid):
+                self._scb(topic, sz, r)
+        finally:
+            # Stay in sync with the stream
+            r.skip()
+        self._puback(op, pid)
+
+    # Record the id of an incoming QoS 2 message. Returns False for a
+    # duplicate (already delivered). When the table is full the message
+    # is still delivered and acknowledged, but untracked: counted in
+    # rx_overflow, it would be delivered again if the server resent it
+    # after a reconnect.
+    def _rx_new(self, pid):
+        if pid in self._rx_pid:
+            return False
+        if 0 in self._rx_pid:
+            self._rx_pid[self._rx_pid.index(0)] = pid
+        else:
+            self.rx_overflow += 1
+        return True
+
+    def _puback(self, op, pid):
         if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
+            self._send_ack(0x40, pid)
         elif op & 6 == 4:
-            assert 0
+            self._send_ack(0x50, pid)
+
+    # Parse the fixed header at _rpos, return (header length,
+    # remaining length) or None if it is not complete yet.
+    def _parse_hdr(self):
+        b = self.rxbuf
+        i = self._rpos + 1
+        n = 0
+        sh = 0
+        while i < self._rend:
+            c = b[i]
+            i += 1
+            n |= (c & 0x7f) << sh
+            if not c & 0x80:
+                return i - self._rpos, n
+            sh += 7
+        return None
+
+    def _wait_msg_buf(self):
+        if self._rpos == self._rend:
+            # Non-blocking: take whatever has arrived, possibly many
+            # packets. Blocking: only the smallest possible packet.
+            self._rpos = self._rend = 0
+            n = self.sock.readinto(self._rxmv, len(self.rxbuf) if self._nb else 2)
+            if self._nb:
+                self.sock.setblocking(True)
+                self._nb = False
+            if n is None:
+                return None
+            if not n:
+                raise OSError(-1)
+            self._rend = n
+        hdr = self._parse_hdr()
+        while hdr is None:
+            self._fill(self._rend - self._rpos + 1)
+            hdr = self._parse_hdr()
+        hl, sz = hdr
+        b = self.rxbuf
+        op = b[self._rpos]
+        if op == 0xd0:  # PINGRESP
+            assert sz == 0
+            self._rpos += 2
+            self.pings = 0
+            return None
+        if op & 0xf0 != 0x30:
+            # Leave the variable header to the caller's _read()
+            self._rpos += 1
+            return self._ctrl(op)
+        if hl + sz > len(b) or self._scb is not None and sz >= self._smin:
+            # Does not fit or is streamed, read the rest piecewise
+            self._rpos += hl
+            self._recv_publish(op, sz)
+            return None
+        self._fill(hl + sz)
+        p = self._rpos
+        i = p + hl
+        topic_len = b[i] << 8 | b[i + 1]
+        i += 2
+        topic = self._rxmv[i:i + topic_len]
+        i += topic_len
+        pid = 0
+        if op & 6:
+            pid = b[i] << 8 | b[i + 1]
+            i += 2
+        end = p + hl + sz
+        self._rpos = end
+        if op & 6 != 4 or self._rx_new(pid):
+            self.cb(topic, self._rxmv[i:end])
+        self._puback(op, pid)
+
+    # True if received bytes are waiting in rxbuf, which a poll() on the
+    # socket won't report.
+    def buffered(self):
+        return self._rpos < self._rend
 
     # Checks whether a pending message from server is available.
     # If not, returns immediately with None. Otherwise, does
     # the same processing as wait_msg.
     def check_msg(self):
+        self._resend_due()
+        if self.buffered():
+            # A packet is already buffered, no need to touch the socket
+            return self.wait_msg()
         self.sock.setblocking(False)
+        self._nb = True
         return self.wait_msg()
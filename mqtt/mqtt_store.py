@@ -0,0 +1,192 @@
+try:
+    import uos as os
+    import ustruct as struct
+except ImportError:
+    import os
+    import struct
+
+# Persistent store-and-forward log for MQTT publishes.
+#
+# Messages are appended as fixed-size records to numbered segment files
+# in a directory (e.g. on /flash or an SD card), buffered in RAM and
+# written `batch` records at a time to limit flash wear. drain() publishes
+# them in order through an MQTTClient; a segment is deleted once all its
+# records were published and acknowledged, and the read position is kept
+# in a small cursor file, saved every `batch` records, so a reboot resends
+# at most one batch.
+#
+# log = MessageLog("/flash/mqlog")
+# log.append(b"sensors/t1", b"21.5", qos=1)
+# ...
+# c.connect()
+# log.drain(c)
+#
+# Record layout (record_size bytes, little endian):
+#   flags (1): 0x80 | qos << 1 | retain
+#   topic length (1), message length (2), topic, message, padding
+
+class MessageLog:
+
+    def __init__(self, path, record_size=128, segment_records=64, batch=8):
+        assert batch <= segment_records
+        self.path = path
+        self.record_size = record_size
+        self.segment_records = segment_records
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass
+        # Write batch, also used as read buffer by drain()
+        self._buf = bytearray(record_size * batch)
+        self._n = 0
+        segs = self._segments()
+        self._wseg = segs[-1] if segs else 1
+        self._wcount = self._records(self._wseg) if segs else 0
+        if segs and self._torn(self._wseg):
+            # Don't append after a torn record, start a new segment
+            self._wseg += 1
+            self._wcount = 0
+        self._rseg = segs[0] if segs else 1
+        self._rrec = 0
+        # Read position last written to the cursor file
+        self._saved = None
+        try:
+            with open(self._name(0), "rb") as f:
+                seg, rec = struct.unpack("<II", f.read(8))
+            if seg in segs:
+                self._rseg = seg
+                self._rrec = rec
+        except (OSError, ValueError):
+            pass
+
+    def _name(self, seg):
+        if not seg:
+            return self.path + "/cursor"
+        return "%s/%08d.seg" % (self.path, seg)
+
+    def _segments(self):
+        return sorted(int(n[:-4]) for n in os.listdir(self.path) if n.endswith(".seg"))
+
+    # Complete records in a segment; a record torn by a power loss
+    # at the end of the file is ignored.
+    def _records(self, seg):
+        try:
+            return os.stat(self._name(seg))[6] // self.record_size
+        except OSError:
+            return 0
+
+    def _torn(self, seg):
+        try:
+            return os.stat(self._name(seg))[6] % self.record_size != 0
+        except OSError:
+            return False
+
+    def append(self, topic, msg, retain=False, qos=0):
+        rs = self.record_size
+        n = len(topic)
+        m = len(msg)
+        assert n < 256 and 4 + n + m <= rs
+        b = self._buf
+        o = self._n * rs
+        b[o] = 0x80 | qos << 1 | retain
+        b[o + 1] = n
+        struct.pack_into("<H", b, o + 2, m)
+        o += 4
+        b[o:o + n] = topic
+        b[o + n:o + n + m] = msg
+        self._n += 1
+        if self._n * rs == len(b):
+            self.flush()
+
+    # Write the buffered records to flash.
+    def flush(self):
+        rs = self.record_size
+        mv = memoryview(self._buf)
+        i = 0
+        while i < self._n:
+            if self._wcount == self.segment_records:
+                self._wseg += 1
+                self._wcount = 0
+            k = min(self._n - i, self.segment_records - self._wcount)
+            with open(self._name(self._wseg), "ab") as f:
+                f.write(mv[i * rs:(i + k) * rs])
+            self._wcount += k
+            i += k
+        self._n = 0
+
+    # Number of records not yet drained.
+    def pending(self):
+        n = self._n
+        for seg in self._segments():
+            n += self._records(seg)
+            if seg == self._rseg:
+                n -= self._rrec
+        return n
+
+    # Publish up to `limit` logged messages (all if None) in order,
+    # return how many were sent. The read position is saved after each
+    # batch of records, once the client has no QoS 1/2 publish in flight
+    # (with inflight > 0), so a reboot during drain() only resends the
+    # current batch. An OSError from the client is propagated after
+    # saving the read position; messages still in flight then are left
+    # to the client's retransmission and not read from the log again.
+    def drain(self, client, limit=None):
+        self.flush()
+        rs = self.record_size
+        buf = self._buf
+        mv = memoryview(buf)
+        sent = 0
+        self._saved = (self._rseg, self._rrec)
+        try:
+            while limit is None or sent < limit:
+                segs = self._segments()
+                if not segs:
+                    break
+                seg = segs[0]
+                if seg != self._rseg:
+                    self._rseg = seg
+                    self._rrec = 0
+                total = self._records(seg)
+                if self._rrec >= total:
+                    client.wait_pending()
+                    os.remove(self._name(seg))
+                    if seg == self._wseg:
+                        self._wseg += 1
+                        self._wcount = 0
+                    continue
+                with open(self._name(seg), "rb") as f:
+                    f.seek(self._rrec * rs)
+                    while self._rrec < total and (limit is None or sent < limit):
+                        k = f.readinto(buf) // rs
+                        for o in range(0, k * rs, rs):
+                            flags = buf[o]
+                            if flags & 0x80:
+                                n = buf[o + 1]
+                                m = buf[o + 2] | buf[o + 3] << 8
+                                topic = mv[o + 4:o + 4 + n]
+                                msg = mv[o + 4 + n:o + 4 + n + m]
+                                qos = flags >> 1 & 3
+                                if qos:
+                                    # May be kept for retransmission
+                                    topic = bytes(topic)
+                                    msg = bytes(msg)
+                                client.publish(topic, msg, flags & 1, qos)
+                                sent += 1
+                            self._rrec += 1
+                            if limit is not None and sent == limit:
+                                break
+                        client.wait_pending()
+                        self._save_cursor()
+                        if not k:
+                            break
+            client.wait_pending()
+        finally:
+            self._save_cursor()
+        return sent
+
+    def _save_cursor(self):
+        pos = (self._rseg, self._rrec)
+        if pos != self._saved:
+            with open(self._name(0), "wb") as f:
+                f.write(struct.pack("<II", *pos))
+            self._saved = pos
@@ -0,0 +1,157 @@
+try:
+    import uselect as select
+except ImportError:
+    import select
+from mqtt_simple import ticks_ms, ticks_diff, ticks_add
+
+# uselect.poll() based event loop: sleeps until a registered socket is
+# readable or a timer is due, then dispatches. MQTT clients are served
+# with wait_msg() on their blocking socket, so unlike a check_msg() loop
+# there is no busy polling and no setblocking() toggling.
+#
+# r = Reactor()
+# r.add_mqtt(c)
+# r.add_socket(server, on_accept)   # e.g. a Wifi/wifi_ap.py style server
+# r.call_every(10000, lambda: c.publish(b"sensors/t1", read_temp()))
+# r.run()
+#
+# Handlers are called as handler(sock, events) and timer callbacks
+# without arguments. A client's keepalive is handled by sending PINGREQ
+# every keepalive/2 seconds; an OSError from the client, including a
+# PINGREQ left unanswered until the next one, goes to on_error(client,
+# exc) or is raised from run().
+
+class Reactor:
+
+    def __init__(self):
+        self._poll = select.poll()
+        # socket -> handler
+        self._socks = {}
+        # [client, registered socket, on_error, keepalive timer]
+        self._clients = []
+        # [deadline, period or 0, callback]
+        self._timers = []
+
+    def add_socket(self, sock, handler, events=select.POLLIN):
+        self._poll.register(sock, events)
+        self._socks[sock] = handler
+
+    def remove_socket(self, sock):
+        if self._socks.pop(sock, None) is not None:
+            self._poll.unregister(sock)
+
+    def add_mqtt(self, client, on_error=None):
+        e = [client, None, on_error, None]
+        if client.keepalive:
+            e[3] = self.call_every(client.keepalive * 500, lambda: self._ping(e))
+        self._clients.append(e)
+
+    def remove_mqtt(self, client):
+        for e in self._clients:
+            if e[0] is client:
+                self._clients.remove(e)
+                if e[1] is not None:
+                    self.remove_socket(e[1])
+                if e[3] is not None:
+                    self.cancel(e[3])
+                return
+
+    # Run callback once in ms milliseconds, returns a handle for cancel().
+    def call_later(self, ms, callback):
+        t = [ticks_add(ticks_ms(), ms), 0, callback]
+        self._timers.append(t)
+        return t
+
+    # Run callback every ms milliseconds, first in ms milliseconds.
+    def call_every(self, ms, callback):
+        t = [ticks_add(ticks_ms(), ms), ms, callback]
+        self._timers.append(t)
+        return t
+
+    def cancel(self, t):
+        if t in self._timers:
+            self._timers.remove(t)
+
+    # Follow reconnects: poll the client's current socket.
+    def _sync(self):
+        for e in self._clients:
+            sock = e[0].sock
+            if sock is not e[1]:
+                if e[1] is not None:
+                    self.remove_socket(e[1])
+                e[1] = sock
+                if sock is not None:
+                    self.add_socket(sock, lambda s, ev, e=e: self._serve(e))
+
+    # Stop polling the failed socket (a hung up socket stays readable)
+    # until the client has a new one.
+    def _error(self, e, exc):
+        self.remove_socket(e[1])
+        if e[2] is None:
+            raise exc
+        e[2](e[0], exc)
+
+    def _serve(self, e):
+        c = e[0]
+        try:
+            c.wait_msg()
+            # Packets left in rxbuf won't show up in poll()
+            while c.buffered():
+                c.wait_msg()
+        except OSError as exc:
+            self._error(e, exc)
+
+    def _ping(self, e):
+        c = e[0]
+        if c.sock is None:
+            return
+        try:
+            if c.pings:
+                raise OSError(-1)
+            c.ping()
+        except OSError as exc:
+            self._error(e, exc)
+
+    # Wait for at most timeout_ms (-1: no limit) and dispatch whatever
+    # is ready.
+    def run_once(self, timeout_ms=-1):
+        self._sync()
+        now = ticks_ms()
+        for e in self._clients:
+            c = e[0]
+            if c.sock is None:
+                continue
+            if c.buffered():
+                timeout_ms = 0
+            elif c.pending():
+                c.resend()
+                if timeout_ms < 0 or timeout_ms > c.resend_ms:
+                    timeout_ms = c.resend_ms
+        for t in self._timers:
+            d = ticks_diff(t[0], now)
+            if d < 0:
+                d = 0
+            if timeout_ms < 0 or d < timeout_ms:
+                timeout_ms = d
+        for ev in self._poll.poll(timeout_ms):
+            h = self._socks.get(ev[0])
+            if h is not None:
+                h(ev[0], ev[1])
+        for e in self._clients:
+            if e[0].sock is not None and e[0].buffered():
+                self._serve(e)
+        now = ticks_ms()
+        for t in self._timers[:]:
+            if ticks_diff(now, t[0]) >= 0 and t in self._timers:
+                if t[1]:
+                    # Absolute schedule, no drift from handler run time
+                    t[0] = ticks_add(t[0], t[1])
+                    if ticks_diff(now, t[0]) >= 0:
+                        t[0] = ticks_add(now, t[1])
+                else:
+                    self._timers.remove(t)
+                t[2]()
+
+    def run(self):
+        while 1:
+            self.run_once()
@@ -0,0 +1,177 @@
+# Minimal MQTT 3.1.1 broker stand-in for host-side testing and
+# benchmarking: one thread per connection on a loopback socket.
+# Handles CONNECT, PUBLISH (QoS 0-2), SUBSCRIBE with + and # wildcards,
+# PINGREQ and DISCONNECT. No sessions, retained messages or auth.
+#
+# b = StubBroker()
+# c = MQTTClient(b"c", "127.0.0.1", b.port)
+import socket
+import ssl
+import struct
+import threading
+
+
+def _recvn(sock, n):
+    b = bytearray(n)
+    mv = memoryview(b)
+    got = 0
+    while got < n:
+        r = sock.recv_into(mv[got:])
+        if not r:
+            raise EOFError
+        got += r
+    return b
+
+
+def _enc_len(n):
+    out = bytearray()
+    while 1:
+        b = n & 0x7f
+        n >>= 7
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def topic_match(flt, topic):
+    f = flt.split(b"/")
+    t = topic.split(b"/")
+    if t[0][:1] == b"$" and f[0] in (b"+", b"#"):
+        return False
+    for i, p in enumerate(f):
+        if p == b"#":
+            return True
+        if i >= len(t) or (p != b"+" and p != t[i]):
+            return False
+    return len(f) == len(t)
+
+
+class StubBroker:
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.ls = socket.socket()
+        self.ls.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.ls.bind((host, port))
+        self.ls.listen(16)
+        self.port = self.ls.getsockname()[1]
+        self.lock = threading.Lock()
+        # (send function, filter, qos, pid counter)
+        self.subs = []
+        self.published = 0
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    # Hook for subclasses, e.g. to wrap the connection in TLS.
+    def wrap(self, conn):
+        return conn
+
+    def _accept(self):
+        while 1:
+            try:
+                conn, _ = self.ls.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            conn = self.wrap(conn)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            conn.close()
+            return
+        wlock = threading.Lock()
+
+        def send(b):
+            with wlock:
+                conn.sendall(b)
+
+        pid = [0]
+        try:
+            while 1:
+                op = _recvn(conn, 1)[0]
+                sz = 0
+                sh = 0
+                while 1:
+                    b = _recvn(conn, 1)[0]
+                    sz |= (b & 0x7f) << sh
+                    if not b & 0x80:
+                        break
+                    sh += 7
+                body = _recvn(conn, sz) if sz else b""
+                t = op & 0xf0
+                if t == 0x10:
+                    send(b"\x20\x02\x00\x00")
+                elif t == 0x30:
+                    qos = op >> 1 & 3
+                    n = body[0] << 8 | body[1]
+                    topic = bytes(body[2:2 + n])
+                    i = 2 + n
+                    if qos:
+                        p = bytes(body[i:i + 2])
+                        i += 2
+                        send((b"\x40\x02" if qos == 1 else b"\x50\x02") + p)
+                    self.published += 1
+                    self._route(topic, memoryview(body)[i:])
+                elif t == 0x60:    # PUBREL
+                    send(b"\x70\x02" + bytes(body[:2]))
+                elif t == 0x50:    # PUBREC for a message we sent
+                    send(b"\x62\x02" + bytes(body[:2]))
+                elif t == 0x80:
+                    i = 2
+                    codes = bytearray()
+                    while i < len(body):
+                        n = body[i] << 8 | body[i + 1]
+                        flt = bytes(body[i + 2:i + 2 + n])
+                        qos = body[i + 2 + n]
+                        i += 3 + n
+                        with self.lock:
+                            self.subs.append((send, flt, qos, pid))
+                        codes.append(qos)
+                    send(b"\x90" + _enc_len(2 + len(codes)) + bytes(body[:2]) + codes)
+                elif t == 0xc0:
+                    send(b"\xd0\x00")
+                elif t == 0xe0:
+                    break
+        except (EOFError, OSError):
+            pass
+        with self.lock:
+            self.subs = [s for s in self.subs if s[0] is not send]
+        conn.close()
+
+    def _route(self, topic, msg):
+        with self.lock:
+            subs = list(self.subs)
+        for send, flt, qos, pid in subs:
+            if not topic_match(flt, topic):
+                continue
+            hdr = struct.pack("!H", len(topic)) + topic
+            if qos:
+                pid[0] = pid[0] % 65535 + 1
+                hdr += struct.pack("!H", pid[0])
+            try:
+                send(bytes((0x30 | qos << 1,)) + _enc_len(len(hdr) + len(msg)) + hdr + msg)
+            except OSError:
+                pass
+
+    def close(self):
+        try:
+            self.ls.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.ls.close()
+
+
+# StubBroker over TLS. The server context issues session tickets, so
+# clients can resume.
+#
+# b = TLSStubBroker("cert.pem", "key.pem")
+# c = MQTTClient(b"c", "127.0.0.1", b.port, ssl=True)
+class TLSStubBroker(StubBroker):
+
+    def __init__(self, certfile, keyfile, host="127.0.0.1", port=0):
+        self.ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ctx.load_cert_chain(certfile, keyfile)
+        StubBroker.__init__(self, host, port)
+
+    def wrap(self, conn):
+        return self.ctx.wrap_socket(conn, server_side=True)